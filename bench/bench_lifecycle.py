@@ -0,0 +1,812 @@
+"""
+Offline benchmark of the cluster lifecycle hot paths
+
+Runs MyCluster.start/stop of both cluster types and the get-cluster-info and scale-cluster
+macros against a local HTTP stand-in for the EMR and STS APIs, with simulated latency,
+pagination and throttling. The same stand-in serves the WebHDFS, YARN ResourceManager and
+HiveServer2 endpoints of the master nodes, which all resolve to it, next to a HiveServer2
+Thrift stand-in. Real boto3 clients talk to the stand-in through AWS_ENDPOINT_URL,
+so client construction, paginators and botocore retries are all exercised.
+
+Reports the wall time of each phase, the API calls per operation and the throttled calls
+(each one triggers a botocore retry). Waiter sleeps are not slept but accounted as
+virtual time, so that the numbers reflect the code and not the EMR provisioning delays.
+
+    python bench/bench_lifecycle.py --sizes 3,10,100,1000 --latency-ms 20 --output bench.json
+    python bench/bench_lifecycle.py --compare bench.json
+
+Requires Python 3, boto3 >= 1.28 (for AWS_ENDPOINT_URL) and the code env requirements.
+"""
+
+import argparse
+import collections
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import pwd
+import random
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT, "python-lib"))
+
+PAGE_SIZE = 50
+BOOT_POLLS = 3
+RESIZE_POLLS = 2
+FLEET_SIZE = 8
+STEP_POLLS = 2
+
+
+class FakeEmr(object):
+    """In-memory EMR clusters, driven by the API calls received by the stand-in server"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clusters = {}
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+        # Activity reported by the ResourceManager and HiveServer2 stand-ins
+        self.activity = {"appsRunning": 0, "appsPending": 0, "hiveSessions": 0, "activeNodes": 0, "nodeMB": 24576, "pendingMB": 0}
+        self.hdfs = {"liveDataNodes": 1, "nodeCapacity": 10 ** 12, "used": 10 ** 10, "replication": 1}
+        # HDFS directories created through the WebHDFS stand-in: path -> owner
+        self.hdfs_dirs = {}
+        self.hive_statements = []
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+    def add_cluster(self, core_count, task_count, instance_type="m5.2xlarge", state="STARTING"):
+        cluster_id = "j-%s" % "".join([random.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") for i in range(13)])
+        cluster = {"id": cluster_id, "state": state, "polls": 0, "groups": [], "instances": [], "tags": [], "steps": [], "stepConcurrency": 1}
+        for (group_type, count) in [("MASTER", 1), ("CORE", core_count), ("TASK", task_count)]:
+            if count or group_type != "TASK":
+                group = {"Id": "ig-%s%s" % (group_type, cluster_id[2:]), "InstanceGroupType": group_type, "InstanceType": instance_type,
+                         "Market": "ON_DEMAND", "RequestedInstanceCount": count, "RunningInstanceCount": count, "polls": 0}
+                cluster["groups"].append(group)
+                self._add_instances(cluster, group, count)
+        self.clusters[cluster_id] = cluster
+        return cluster_id
+
+    def _add_instances(self, cluster, group, count):
+        for i in range(count):
+            n = len(cluster["instances"]) + 10
+            cluster["instances"].append({
+                "Id": "ci-%d" % n, "Ec2InstanceId": "i-%012d" % n,
+                # Services of the master are served by the local stand-in
+                "PrivateIpAddress": "127.0.0.1" if group["InstanceGroupType"] == "MASTER" else "10.0.%d.%d" % (n // 250, n % 250 + 1),
+                "PrivateDnsName": "ip-10-0-%d-%d.ec2.internal" % (n // 250, n % 250 + 1),
+                "InstanceGroupId": group["Id"], "InstanceType": group["InstanceType"], "Market": "ON_DEMAND",
+                "Status": {"State": "RUNNING"}, "groupType": group["InstanceGroupType"]
+            })
+
+    # EMR operations
+
+    def RunJobFlow(self, params):
+        groups = dict([(g["InstanceRole"], g["InstanceCount"]) for g in params["Instances"].get("InstanceGroups", [])])
+        cluster_id = self.add_cluster(groups.get("CORE", 0), groups.get("TASK", 0))
+        return {"JobFlowId": cluster_id}
+
+    def _poll_state(self, cluster):
+        cluster["polls"] += 1
+        if cluster["state"] == "STARTING" and cluster["polls"] >= BOOT_POLLS:
+            cluster["state"] = "WAITING"
+
+    def DescribeCluster(self, params):
+        cluster = self.clusters[params["ClusterId"]]
+        self._poll_state(cluster)
+        master = [i for i in cluster["instances"] if i["groupType"] == "MASTER"][0]
+        now = time.time()
+        return {"Cluster": {
+            "Id": cluster["id"], "Name": cluster["id"], "ReleaseLabel": "emr-6.10.0",
+            "Status": {"State": cluster["state"], "Timeline": {"CreationDateTime": now - 600, "ReadyDateTime": now}},
+            "MasterPublicDnsName": master["PrivateDnsName"], "InstanceCollectionType": "INSTANCE_GROUP",
+            "Applications": [{"Name": a} for a in ["Hadoop", "Hive", "Spark", "Tez"]],
+            "Configurations": [], "Tags": cluster["tags"]
+        }}
+
+    def ListClusters(self, params):
+        clusters = []
+        for cluster in self.clusters.values():
+            self._poll_state(cluster)
+            if cluster["state"] in params.get("ClusterStates", [cluster["state"]]):
+                clusters.append({"Id": cluster["id"], "Name": cluster["id"], "Status": {"State": cluster["state"]}})
+        return self._paginate("Clusters", clusters, params)
+
+    def ListInstances(self, params):
+        cluster = self.clusters[params["ClusterId"]]
+        types = params.get("InstanceGroupTypes") or [params.get("InstanceFleetType")]
+        instances = [dict([(k, v) for (k, v) in i.items() if k != "groupType"]) for i in cluster["instances"] if i["groupType"] in types]
+        return self._paginate("Instances", instances, params)
+
+    def ListInstanceGroups(self, params):
+        cluster = self.clusters[params["ClusterId"]]
+        groups = []
+        for g in cluster["groups"]:
+            g["polls"] += 1
+            resizing = g["RunningInstanceCount"] != g["RequestedInstanceCount"]
+            if resizing and g["polls"] >= RESIZE_POLLS:
+                g["RunningInstanceCount"] = g["RequestedInstanceCount"]
+                resizing = False
+            group = dict([(k, v) for (k, v) in g.items() if k != "polls"])
+            group["Status"] = {"State": "RESIZING" if resizing else "RUNNING"}
+            groups.append(group)
+        return self._paginate("InstanceGroups", groups, params)
+
+    def ModifyInstanceGroups(self, params):
+        cluster = self.clusters[params["ClusterId"]]
+        for change in params["InstanceGroups"]:
+            for g in cluster["groups"]:
+                if g["Id"] == change["InstanceGroupId"]:
+                    g["RequestedInstanceCount"] = change["InstanceCount"]
+                    g["polls"] = 0
+        return {}
+
+    def AddInstanceGroups(self, params):
+        cluster = self.clusters[params["JobFlowId"]]
+        ids = []
+        for spec in params["InstanceGroups"]:
+            group = {"Id": "ig-%s%d" % (spec["InstanceRole"], len(cluster["groups"])), "InstanceGroupType": spec["InstanceRole"],
+                     "InstanceType": spec["InstanceType"], "Market": "ON_DEMAND",
+                     "RequestedInstanceCount": spec["InstanceCount"], "RunningInstanceCount": 0, "polls": 0}
+            cluster["groups"].append(group)
+            ids.append(group["Id"])
+        return {"JobFlowId": cluster["id"], "InstanceGroupIds": ids}
+
+    def AddTags(self, params):
+        cluster = self.clusters[params["ResourceId"]]
+        keys = [t["Key"] for t in params["Tags"]]
+        cluster["tags"] = [t for t in cluster["tags"] if t["Key"] not in keys] + params["Tags"]
+        return {}
+
+    def RemoveTags(self, params):
+        cluster = self.clusters[params["ResourceId"]]
+        cluster["tags"] = [t for t in cluster["tags"] if t["Key"] not in params["TagKeys"]]
+        return {}
+
+    def PutAutoTerminationPolicy(self, params):
+        self.clusters[params["ClusterId"]]["autoTerminationPolicy"] = params["AutoTerminationPolicy"]
+        return {}
+
+    def RemoveAutoTerminationPolicy(self, params):
+        self.clusters[params["ClusterId"]].pop("autoTerminationPolicy", None)
+        return {}
+
+    def webhdfs_put(self, path, params):
+        """WebHDFS as the NameNode answers it: MKDIRS returns a boolean, SETOWNER an empty body"""
+        if params.get("op") == "MKDIRS":
+            self.hdfs_dirs.setdefault(path, params.get("user.name"))
+            return {"boolean": True}
+        if params.get("op") == "SETOWNER" and path in self.hdfs_dirs:
+            self.hdfs_dirs[path] = params["owner"]
+            return ""
+        return None
+
+    def get_yarn_metrics(self):
+        a = self.activity
+        return {"clusterMetrics": {
+            "appsRunning": a["appsRunning"], "appsPending": a["appsPending"], "activeNodes": a["activeNodes"],
+            "totalMB": a["activeNodes"] * a["nodeMB"], "pendingMB": a["pendingMB"], "availableMB": 0 if a["appsRunning"] else a["activeNodes"] * a["nodeMB"]
+        }}
+
+    def get_namenode_jmx(self):
+        h = self.hdfs
+        return {"beans": [
+            {"name": "Hadoop:service=NameNode,name=FSNamesystem", "tag.HAState": "active", "CapacityTotal": h["liveDataNodes"] * h["nodeCapacity"],
+             "CapacityUsed": h["used"], "UnderReplicatedBlocks": 0, "MissingBlocks": 0},
+            {"name": "Hadoop:service=NameNode,name=FSNamesystemState", "NumLiveDataNodes": h["liveDataNodes"]}
+        ]}
+
+    def get_namenode_conf(self):
+        return {"properties": [{"key": "dfs.replication", "value": str(self.hdfs["replication"])}]}
+
+    def get_hiveserver2_jmx(self):
+        return {"beans": [{"name": "metrics:name=hs2_open_sessions", "Value": self.activity["hiveSessions"]}]}
+
+    def ModifyCluster(self, params):
+        cluster = self.clusters[params["ClusterId"]]
+        cluster["stepConcurrency"] = params["StepConcurrencyLevel"]
+        return {"StepConcurrencyLevel": cluster["stepConcurrency"]}
+
+    def AddJobFlowSteps(self, params):
+        cluster = self.clusters[params["JobFlowId"]]
+        ids = []
+        for spec in params["Steps"]:
+            step = {"Id": "s-%d%s" % (len(cluster["steps"]), cluster["id"][2:]), "Name": spec["Name"], "Status": {"State": "PENDING"}, "polls": 0}
+            cluster["steps"].append(step)
+            ids.append(step["Id"])
+        return {"StepIds": ids}
+
+    def ListSteps(self, params):
+        cluster = self.clusters[params["ClusterId"]]
+        # Steps run for STEP_POLLS listings, at most stepConcurrency at a time
+        if not params.get("Marker"):
+            for step in cluster["steps"]:
+                if step["Status"]["State"] == "RUNNING":
+                    step["polls"] += 1
+                    if step["polls"] >= STEP_POLLS:
+                        step["Status"]["State"] = "COMPLETED"
+            running = len([x for x in cluster["steps"] if x["Status"]["State"] == "RUNNING"])
+            for step in cluster["steps"]:
+                if step["Status"]["State"] == "PENDING" and running < cluster["stepConcurrency"]:
+                    step["Status"]["State"] = "RUNNING"
+                    running += 1
+        steps = [dict([(k, v) for (k, v) in x.items() if k != "polls"]) for x in reversed(cluster["steps"])]
+        return self._paginate("Steps", steps, params)
+
+    def TerminateJobFlows(self, params):
+        for cluster_id in params["JobFlowIds"]:
+            self.clusters[cluster_id]["state"] = "TERMINATED"
+        return {}
+
+    def _paginate(self, key, items, params):
+        start = int(params.get("Marker") or 0)
+        result = {key: items[start:start + PAGE_SIZE]}
+        if start + PAGE_SIZE < len(items):
+            result["Marker"] = str(start + PAGE_SIZE)
+        return result
+
+
+ASSUME_ROLE_RESPONSE = """<AssumeRoleResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+<AssumeRoleResult><Credentials><AccessKeyId>ASIABENCHMARK</AccessKeyId><SecretAccessKey>secret</SecretAccessKey>
+<SessionToken>token</SessionToken><Expiration>%s</Expiration></Credentials>
+<AssumedRoleUser><Arn>arn:aws:sts::123456789012:assumed-role/bench/dss-emr-access</Arn><AssumedRoleId>AROA:dss-emr-access</AssumedRoleId></AssumedRoleUser>
+</AssumeRoleResult><ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata></AssumeRoleResponse>"""
+
+
+THROTTLING_XML_RESPONSE = """<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code><Message>Rate exceeded</Message></Error>
+<RequestId>bench</RequestId></ErrorResponse>"""
+
+
+def make_hiveserver2_server(backend, latency):
+    """
+    HiveServer2 stand-in for PyHive: SASL PLAIN authentication as with
+    hive.server2.authentication=NONE, then framed binary Thrift. Statements are recorded,
+    each one after the given latency.
+    """
+
+    from TCLIService import TCLIService, ttypes
+    from thrift.protocol import TBinaryProtocol
+    from thrift.transport import TTransport
+
+    success = lambda: ttypes.TStatus(statusCode=ttypes.TStatusCode.SUCCESS_STATUS)
+    handle = lambda: ttypes.THandleIdentifier(guid=os.urandom(16), secret=os.urandom(16))
+
+    class Service(object):
+        def OpenSession(self, req):
+            with backend.lock:
+                backend.calls["HiveServer2 OpenSession"] += 1
+            return ttypes.TOpenSessionResp(status=success(), serverProtocolVersion=req.client_protocol,
+                                           sessionHandle=ttypes.TSessionHandle(sessionId=handle()))
+
+        def ExecuteStatement(self, req):
+            time.sleep(latency)
+            with backend.lock:
+                backend.calls["HiveServer2 ExecuteStatement"] += 1
+                backend.hive_statements.append(req.statement)
+            return ttypes.TExecuteStatementResp(status=success(), operationHandle=ttypes.TOperationHandle(
+                operationId=handle(), operationType=ttypes.TOperationType.EXECUTE_STATEMENT, hasResultSet=False))
+
+        def CloseOperation(self, req):
+            return ttypes.TCloseOperationResp(status=success())
+
+        def CloseSession(self, req):
+            return ttypes.TCloseSessionResp(status=success())
+
+    processor = TCLIService.Processor(Service())
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            # SASL negotiation: START with the mechanism, then the PLAIN credentials
+            for expected in (1, 2):
+                (status, length) = struct.unpack(">BI", self._read(5))
+                self._read(length)
+                if status != expected:
+                    return
+            self.request.sendall(struct.pack(">BI", 5, 0))
+            while True:
+                header = self._read(4)
+                if not header:
+                    return
+                request = TTransport.TMemoryBuffer(self._read(struct.unpack(">I", header)[0]))
+                response = TTransport.TMemoryBuffer()
+                processor.process(TBinaryProtocol.TBinaryProtocol(request), TBinaryProtocol.TBinaryProtocol(response))
+                data = response.getvalue()
+                self.request.sendall(struct.pack(">I", len(data)) + data)
+
+        def _read(self, n):
+            data = b""
+            while len(data) < n:
+                chunk = self.request.recv(n - len(data))
+                if not chunk:
+                    return b""
+                data += chunk
+            return data
+
+    class Server(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    return Server(("127.0.0.1", 0), Handler)
+
+
+def check_hive_fallback(dku_emr):
+    """Creates databases through a beeline stand-in, HiveServer2 refusing Thrift connections"""
+
+    directory = tempfile.mkdtemp(prefix="bench-")
+    with open(os.path.join(directory, "beeline"), "w") as f:
+        f.write("#!/bin/sh\necho \"$@\" >> %s/calls\n" % directory)
+    os.chmod(os.path.join(directory, "beeline"), 0o755)
+    closed = ThreadingHTTPServer(("127.0.0.1", 0), BaseHTTPRequestHandler)
+    closed.server_close()
+
+    (port, path) = (dku_emr.HIVESERVER2_PORT, os.environ["PATH"])
+    dku_emr.HIVESERVER2_PORT = closed.server_port
+    os.environ["PATH"] = "%s:%s" % (directory, path)
+    try:
+        dku_emr.create_hive_databases("127.0.0.1", ["a", "b"])
+    finally:
+        (dku_emr.HIVESERVER2_PORT, os.environ["PATH"]) = (port, path)
+    with open(os.path.join(directory, "calls")) as f:
+        calls = f.read().splitlines()
+    if len(calls) != 1 or "create database if not exists `a`; create database if not exists `b`;" not in calls[0]:
+        raise Exception("Unexpected beeline fallback: %s" % calls)
+
+
+def make_server(backend, latency, throttle_rate):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+            target = self.headers.get("X-Amz-Target")
+            if target:
+                operation = target.split(".")[-1]
+            else:
+                operation = parse_qs(body).get("Action", ["Unknown"])[0]
+
+            time.sleep(latency)
+            with backend.lock:
+                backend.calls[operation] += 1
+                if random.random() < throttle_rate:
+                    backend.throttled[operation] += 1
+                    if operation == "AssumeRole":
+                        return self._reply(400, THROTTLING_XML_RESPONSE, "text/xml")
+                    return self._reply(400, {"__type": "ThrottlingException", "message": "Rate exceeded"})
+                if operation == "AssumeRole":
+                    expiration = (datetime.datetime.utcnow() + datetime.timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+                    return self._reply(200, ASSUME_ROLE_RESPONSE % expiration, "text/xml")
+                try:
+                    result = getattr(backend, operation)(json.loads(body or "{}"))
+                except AttributeError:
+                    return self._reply(400, {"__type": "ValidationException", "message": "%s is not simulated" % operation})
+            self._reply(200, result)
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            handlers = {"/ws/v1/cluster/metrics": ("ResourceManager", backend.get_yarn_metrics), "/jmx": ("HiveServer2", backend.get_hiveserver2_jmx),
+                        "/conf": ("NameNode", backend.get_namenode_conf)}
+            # The NameNode and HiveServer2 share the port, tell their JMX queries apart
+            if path == "/jmx" and parse_qs(self.path.partition("?")[2]).get("qry", [""])[0].startswith("Hadoop:service=NameNode"):
+                handlers[path] = ("NameNode", backend.get_namenode_jmx)
+            if path not in handlers:
+                return self._reply(404, {"message": "%s is not simulated" % path}, "application/json")
+            time.sleep(latency)
+            with backend.lock:
+                backend.calls[handlers[path][0]] += 1
+                result = handlers[path][1]()
+            self._reply(200, result, "application/json")
+
+        def do_PUT(self):
+            path = self.path.split("?")[0]
+            params = dict([(k, v[0]) for (k, v) in parse_qs(self.path.partition("?")[2]).items()])
+            if not path.startswith("/webhdfs/v1/"):
+                return self._reply(404, {"message": "%s is not simulated" % path}, "application/json")
+            time.sleep(latency)
+            with backend.lock:
+                backend.calls["WebHDFS %s" % params.get("op")] += 1
+                result = backend.webhdfs_put(path[len("/webhdfs/v1"):], params)
+            if result is None:
+                return self._reply(404, {"RemoteException": {"message": "%s is not simulated on %s" % (params.get("op"), path)}}, "application/json")
+            self._reply(200, result, "application/json")
+
+        def _reply(self, status, payload, content_type="application/x-amz-json-1.1"):
+            data = (payload if isinstance(payload, str) else json.dumps(payload)).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        # The default backlog of 5 drops connections when many clients connect at once
+        request_queue_size = 128
+
+    return Server(("127.0.0.1", 0), Handler)
+
+
+METADATA = {
+    "latest/dynamic/instance-identity/document": json.dumps({"region": "us-east-1", "accountId": "123456789012", "instanceId": "i-0bench"}),
+    "latest/meta-data/mac": "0a:00:00:00:00:01",
+    "latest/meta-data/network/interfaces/macs/0a:00:00:00:00:01/subnet-id": "subnet-bench"
+}
+
+
+def make_metadata_server(calls, token_delay=None):
+    """
+    IMDSv2-only stand-in for the EC2 metadata service: GETs need a session token. With a
+    token delay, it behaves as seen from a container with a hop limit of 1: the token never
+    comes back in time, IMDSv1 GETs are answered.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_PUT(self):
+            calls["PUT %s" % self.path] += 1
+            if token_delay is not None:
+                time.sleep(token_delay)
+            if self.path != "/latest/api/token" or not self.headers.get("X-aws-ec2-metadata-token-ttl-seconds"):
+                return self._reply(400, "")
+            self._reply(200, "bench-token")
+
+        def do_GET(self):
+            calls["GET %s" % self.path] += 1
+            if token_delay is None and self.headers.get("X-aws-ec2-metadata-token") != "bench-token":
+                return self._reply(401, "")
+            text = METADATA.get(self.path.lstrip("/"))
+            self._reply(200 if text is not None else 404, text or "")
+
+        def _reply(self, status, text):
+            data = text.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+
+
+def check_metadata(metadata_server, calls):
+    """
+    Runs the metadata lookups of a cluster start against the IMDSv2 stand-in, then against
+    a stand-in whose tokens time out, where IMDSv1 must be used, and against an endpoint
+    that refuses connections, where the failure must be remembered
+    """
+
+    import dku_ec2_metadata
+
+    def reset(endpoint):
+        dku_ec2_metadata.METADATA_ENDPOINT = endpoint
+        dku_ec2_metadata._token = None
+        dku_ec2_metadata._identity_document = None
+        dku_ec2_metadata._unavailable_until = 0
+        dku_ec2_metadata._token_unavailable_until = 0
+        if os.path.exists(dku_ec2_metadata.IDENTITY_DOCUMENT_CACHE_FILE):
+            os.remove(dku_ec2_metadata.IDENTITY_DOCUMENT_CACHE_FILE)
+
+    reset("http://127.0.0.1:%d" % metadata_server.server_port)
+    calls.clear()
+    start = time.time()
+    found = (dku_ec2_metadata.get_region(), dku_ec2_metadata.get_subnet(), dku_ec2_metadata.get_account_id())
+    seconds = time.time() - start
+    if found != ("us-east-1", "subnet-bench", "123456789012") or calls["PUT /latest/api/token"] != 1:
+        raise Exception("Unexpected metadata lookups: %s, calls %s" % (found, dict(calls)))
+    lookups = dict(calls)
+
+    hop_limited = make_metadata_server(collections.Counter(), token_delay=0.5)
+    threading.Thread(target=hop_limited.serve_forever, daemon=True).start()
+    reset("http://127.0.0.1:%d" % hop_limited.server_port)
+    timeout = dku_ec2_metadata.TIMEOUT
+    dku_ec2_metadata.TIMEOUT = (1.0, 0.2)
+    try:
+        found = (dku_ec2_metadata.get_region(), dku_ec2_metadata.get_subnet())
+    finally:
+        dku_ec2_metadata.TIMEOUT = timeout
+        hop_limited.shutdown()
+    if found != ("us-east-1", "subnet-bench") or dku_ec2_metadata._unavailable_until:
+        raise Exception("No IMDSv1 fallback when the metadata token times out: %s" % (found,))
+
+    # Nothing listens on the port of a closed server
+    closed = ThreadingHTTPServer(("127.0.0.1", 0), BaseHTTPRequestHandler)
+    closed.server_close()
+    reset("http://127.0.0.1:%d" % closed.server_port)
+    dku_ec2_metadata.get_region()
+    if not dku_ec2_metadata._unavailable_until:
+        raise Exception("The unavailability of the metadata service is not remembered")
+    retry_start = time.time()
+    if dku_ec2_metadata.get_subnet() is not None or time.time() - retry_start > 0.01:
+        raise Exception("The metadata service is queried again after failing")
+
+    reset("http://127.0.0.1:%d" % metadata_server.server_port)
+    return {"wallSeconds": round(seconds, 4), "calls": lookups, "totalCalls": sum(lookups.values())}
+
+
+class VirtualClock(object):
+    """Replaces the time module of the waiters: sleeps are accounted, not slept"""
+
+    def __init__(self):
+        self.slept = 0.0
+
+    def sleep(self, seconds):
+        self.slept += seconds
+
+    def time(self):
+        return time.time() + self.slept
+
+    def strftime(self, format):
+        return time.strftime(format, time.localtime(self.time()))
+
+
+def install_dataiku_stand_ins(settings_by_id):
+    """The DSS modules are only available inside DSS: provide the parts the plugin uses"""
+
+    dataiku = types.ModuleType("dataiku")
+    dataiku.api_client = lambda: types.SimpleNamespace(
+        get_cluster=lambda cluster_id: types.SimpleNamespace(get_settings=lambda: settings_by_id[cluster_id], stop=settings_by_id[cluster_id].stop),
+        list_clusters=lambda: [{"id": cluster_id} for cluster_id in sorted(settings_by_id)])
+    cluster = types.ModuleType("dataiku.cluster")
+    cluster.Cluster = object
+    runnables = types.ModuleType("dataiku.runnables")
+    runnables.Runnable = object
+    runnables.ResultTable = ResultTable
+    dataiku.cluster = cluster
+    dataiku.runnables = runnables
+    sys.modules.update({"dataiku": dataiku, "dataiku.cluster": cluster, "dataiku.runnables": runnables})
+
+
+class ResultTable(object):
+    def __init__(self):
+        self.columns = []
+        self.records = []
+
+    def set_name(self, name):
+        self.name = name
+
+    def add_column(self, name, label, type):
+        self.columns.append(name)
+
+    def add_record(self, record):
+        self.records.append(record)
+
+
+class FakeClusterSettings(object):
+    def __init__(self, config, data):
+        self.config = config
+        self.data = data
+        self.saves = 0
+        self.stopped = False
+
+    def get_raw(self):
+        return {"params": {"config": self.config}}
+
+    def get_plugin_data(self):
+        return self.data
+
+    def save(self):
+        self.saves += 1
+
+    def stop(self):
+        self.stopped = True
+
+
+def load_component(path):
+    spec = importlib.util.spec_from_file_location("bench_%s" % path.replace("/", "_").replace("-", "_").replace(".", "_"), os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_scenario(backend, clock, size, metadata, verbose=False):
+    import dku_emr
+
+    dku_emr.clear_session_cache()
+    core = max(1, min(size - 1, 10))
+    task = max(0, size - 1 - core)
+    config = {
+        "awsRegionId": "us-east-1", "subnetId": "subnet-bench", "assumeRole": "arn:aws:iam::123456789012:role/bench",
+        "masterInstanceType": "m5.2xlarge", "coreInstanceType": "m5.2xlarge", "coreInstanceCount": core,
+        "taskInstanceType": "m5.2xlarge", "taskInstanceCount": task, "emrVersion": "6.10.0",
+        "metastoreDBMode": "TRANSIENT", "nodesRole": "EMR_EC2_DefaultRole", "serviceRole": "EMR_DefaultRole",
+        "databasesToCreate": "dataiku", "sizeExecutors": True
+    }
+
+    settings_by_id = {}
+    install_dataiku_stand_ins(settings_by_id)
+    create_cluster = load_component("python-clusters/emr-create-cluster/cluster.py")
+    attach_cluster = load_component("python-clusters/emr-attach-to-existing-cluster/cluster.py")
+    get_cluster_info = load_component("python-runnables/get-cluster-info/runnable.py")
+    scale_cluster = load_component("python-runnables/scale-cluster/runnable.py")
+    fleet_operations = load_component("python-runnables/fleet-operations/runnable.py")
+    submit_steps = load_component("python-runnables/submit-steps/runnable.py")
+    idle_manager = load_component("python-runnables/idle-manager/runnable.py")
+    autoscale_cluster = load_component("python-runnables/autoscale-cluster/runnable.py")
+    idle_manager.time = clock
+    # The components configure the root logger when loaded
+    logging.getLogger().setLevel(logging.INFO if verbose else logging.WARNING)
+
+    phases = collections.OrderedDict()
+    phases["metadata"] = dict(check_metadata(*metadata), virtualWaitSeconds=0.0, throttled=0)
+
+    def phase(name, f):
+        backend.reset_counters()
+        slept = clock.slept
+        start = time.time()
+        result = f()
+        phases[name] = {
+            "wallSeconds": round(time.time() - start, 4),
+            "virtualWaitSeconds": round(clock.slept - slept, 1),
+            "calls": dict(backend.calls),
+            "totalCalls": sum(backend.calls.values()),
+            "throttled": sum(backend.throttled.values())
+        }
+        return result
+
+    cluster = create_cluster.MyCluster("bench", "bench", config, {})
+    (keys, data) = phase("start", cluster.start)
+    home_dir = "/user/%s" % pwd.getpwuid(os.geteuid()).pw_name
+    if backend.hdfs_dirs.get(home_dir) != pwd.getpwuid(os.geteuid()).pw_name:
+        raise Exception("HDFS home directory not created through WebHDFS: %s" % backend.hdfs_dirs)
+    if phases["start"]["calls"].get("HiveServer2 OpenSession") != 1 or "create database if not exists `dataiku`" not in backend.hive_statements:
+        raise Exception("Hive databases not created in a HiveServer2 session: %s" % backend.hive_statements)
+    check_hive_fallback(dku_emr)
+    settings_by_id["bench"] = FakeClusterSettings(config, data)
+
+    existing_id = backend.add_cluster(core, task, state="WAITING")
+    attach_config = dict(config, emrClusterId=existing_id)
+    phase("attach", attach_cluster.MyCluster("attach", "attach", attach_config, {}).start)
+
+    phase("get-cluster-info", lambda: get_cluster_info.MyRunnable("BENCH", {"dss_cluster_id": "bench"}, {}).run(lambda p: None))
+    # One CORE node less, as far as the HDFS check on the NameNode stand-in allows, with the
+    # replication factor EMR sets for the size of the cluster
+    replication = 1 if core < 4 else 2 if core < 10 else 3
+    backend.hdfs.update({"liveDataNodes": core, "replication": replication})
+    scale_result = phase("scale-cluster", lambda: scale_cluster.MyRunnable("BENCH", {
+        "dss_cluster_id": "bench", "core_group_target_instances": max(1, core - 1), "task_group_target_instances": task + 5,
+        "wait_for_completion": True}, {}).run(lambda p: None))
+    if core > 1 and (scale_result["coreShrink"] or {}).get("allowed") != min(core, max(core - 1, replication)):
+        raise Exception("Unexpected CORE shrink: %s" % scale_result["coreShrink"])
+    if [n["count"] for n in settings_by_id["bench"].data["workerNodes"] if n["nodeType"] == "TASK"] != [task + 5]:
+        raise Exception("Worker nodes not updated in the cluster data: %s" % settings_by_id["bench"].data["workerNodes"])
+    phase("submit-steps", lambda: submit_steps.MyRunnable("BENCH", {
+        "dss_cluster_id": "bench", "steps": "\n".join(["compact_%d: hive -e \"ALTER TABLE t%d CONCATENATE\"" % (i, i) for i in range(20)]),
+        "step_concurrency_level": 5, "wait_for_completion": True}, {}).run(lambda p: None))
+
+    # Busy cluster with 3 nodes worth of pending memory: the autoscaler adds 3 TASK nodes.
+    # The ResourceManager stand-in is on the local server.
+    backend.activity.update({"appsRunning": 4, "appsPending": 2, "activeNodes": size + 5, "pendingMB": 3 * backend.activity["nodeMB"]})
+    autoscale_result = phase("autoscale-cluster", lambda: autoscale_cluster.MyRunnable("BENCH", {
+        "dss_cluster_id": "bench", "min_task_instances": 0, "max_task_instances": task + 100, "spare_nodes": 1}, {}).run(lambda p: None))
+    backend.activity.update({"appsRunning": 0, "appsPending": 0, "pendingMB": 0})
+    if autoscale_result["decisions"][0]["targetTaskInstances"] != task + 8 or autoscale_result["decisions"][0]["action"] != "scaled out":
+        raise Exception("Unexpected autoscaler decisions: %s" % autoscale_result["decisions"])
+
+    # A fleet of attached clusters, processed one at a time then concurrently
+    for i in range(FLEET_SIZE):
+        settings_by_id["fleet-%d" % i] = FakeClusterSettings(attach_config, {"emrClusterId": backend.add_cluster(core, task, state="WAITING")})
+    for (name, concurrency) in [("fleet-sequential", 1), ("fleet-concurrent", FLEET_SIZE)]:
+        phase(name, lambda: fleet_operations.MyRunnable("BENCH", {
+            "dss_cluster_ids": "fleet-*", "operation": "inventory", "max_concurrent_clusters": concurrency,
+            "max_calls_per_second": 100, "max_calls_burst": 100}, {}).run(lambda p: None))
+
+    # Idle for 2 hours, polled every 5 minutes: TASK nodes removed after 30 minutes, then stopped.
+    # The ResourceManager and HiveServer2 stand-ins are on the local server.
+    settings_by_id["idle"] = FakeClusterSettings(config, dict(data))
+    idle_result = phase("idle-manager", lambda: idle_manager.MyRunnable("BENCH", {
+        "dss_cluster_id": "idle", "shrink_after_idle_minutes": 30, "terminate_after_idle_minutes": 120, "final_action": "STOP",
+        "loop_minutes": 180, "poll_interval_seconds": 300}, {}).run(lambda p: None))
+    if not settings_by_id["idle"].stopped or not [d for d in idle_result["decisions"] if d["action"].startswith("removed")]:
+        raise Exception("Unexpected idle manager decisions: %s" % idle_result["decisions"])
+
+    phase("stop", lambda: cluster.stop(data))
+
+    return {"instances": size, "phases": phases, "sessionStats": dku_emr.get_session_stats()}
+
+
+def print_report(report, baseline=None):
+    baseline_phases = {}
+    if baseline:
+        for result in baseline["results"]:
+            for (name, p) in result["phases"].items():
+                baseline_phases[(result["instances"], name)] = p
+
+    print("commit %s, latency %dms, throttle rate %.2f" % (report["commit"], report["latencyMs"], report["throttleRate"]))
+    print("%9s %-18s %10s %10s %8s %9s  %s" % ("instances", "phase", "wall (s)", "virtual(s)", "calls", "throttled", "vs baseline"))
+    for result in report["results"]:
+        for (name, p) in result["phases"].items():
+            delta = ""
+            base = baseline_phases.get((result["instances"], name))
+            if base:
+                delta = "wall %+.3fs, calls %+d" % (p["wallSeconds"] - base["wallSeconds"], p["totalCalls"] - base["totalCalls"])
+            print("%9d %-18s %10.3f %10.1f %8d %9d  %s" % (result["instances"], name, p["wallSeconds"], p["virtualWaitSeconds"],
+                                                          p["totalCalls"], p["throttled"], delta))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the EMR cluster lifecycle")
+    parser.add_argument("--sizes", default="3,10,100,1000", help="comma-separated cluster sizes, in instances")
+    parser.add_argument("--latency-ms", type=int, default=20, help="simulated latency of each AWS API call")
+    parser.add_argument("--setup-latency-ms", type=int, default=200, help="simulated latency of the HiveServer2 statements")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of AWS API calls answered with a ThrottlingException")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the plugin")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+
+    backend = FakeEmr()
+    server = make_server(backend, args.latency_ms / 1000.0, args.throttle_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    metadata_calls = collections.Counter()
+    metadata_server = make_metadata_server(metadata_calls)
+    threading.Thread(target=metadata_server.serve_forever, daemon=True).start()
+    hiveserver2 = make_hiveserver2_server(backend, args.setup_latency_ms / 1000.0)
+    threading.Thread(target=hiveserver2.serve_forever, daemon=True).start()
+    os.environ.update({
+        "AWS_ENDPOINT_URL": "http://127.0.0.1:%d" % server.server_port,
+        "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench", "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_EC2_METADATA_SERVICE_ENDPOINT": "http://127.0.0.1:%d" % metadata_server.server_port
+    })
+
+    import botocore.waiter
+    import dku_cluster_services
+    import dku_emr
+    import dku_emr_idle
+    import dku_emr_scaling
+    import dku_ec2_metadata
+    dku_ec2_metadata.IDENTITY_DOCUMENT_CACHE_FILE = os.path.join(tempfile.mkdtemp(prefix="bench-"), "instance-identity.json")
+    clock = VirtualClock()
+    botocore.waiter.time = clock
+    dku_emr.time = clock
+    dku_emr_scaling.time = clock
+    dku_emr_idle.time = clock
+    dku_cluster_services.RESOURCE_MANAGER_PORT = server.server_port
+    dku_cluster_services.NAMENODE_HTTP_PORT = server.server_port
+    dku_cluster_services.NAMENODE_HTTP_PORT_HADOOP2 = server.server_port
+    dku_cluster_services.HIVESERVER2_WEBUI_PORT = server.server_port
+    dku_emr.HIVESERVER2_PORT = hiveserver2.server_address[1]
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).decode("utf-8").strip()
+    except Exception:
+        commit = "unknown"
+
+    report = {"commit": commit, "latencyMs": args.latency_ms, "throttleRate": args.throttle_rate, "results": []}
+    for size in [int(x) for x in args.sizes.split(",")]:
+        report["results"].append(run_scenario(backend, clock, size, (metadata_server, metadata_calls), verbose=args.verbose))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import boto3
 import os, json, logging
 import dku_emr
+import dku_emr_tracing
 from dataiku.cluster import Cluster
 
 # This actually belongs in the main entry point
@@ -15,11 +16,18 @@ class MyCluster(Cluster):
         self.plugin_config = plugin_config
        
     def start(self):
-        region_name = self.config.get("awsRegionId") or dku_emr.get_current_region()
-        client = dku_emr.get_emr_client(self.config, region_name)
-        clusterId = self.config["emrClusterId"]
-        logging.info("Attaching to EMR cluster id %s" % clusterId)
-        return dku_emr.make_cluster_keys_and_data(client, clusterId, create_user_dir=True)
+        tracer = dku_emr_tracing.PhaseTracer("attach")
+        try:
+            with tracer.span("get_client"):
+                region_name = self.config.get("awsRegionId") or dku_emr.get_current_region()
+                client = dku_emr.get_emr_client(self.config, region_name)
+            clusterId = self.config["emrClusterId"]
+            logging.info("Attaching to EMR cluster id %s" % clusterId)
+            return dku_emr.make_cluster_keys_and_data(client, clusterId, create_user_dir=True,
+                        size_executors=self.config.get("sizeExecutors", False), io_profile=self.config.get("ioProfile"), tracer=tracer)
+        finally:
+            if self.config.get("metricsExportPath"):
+                tracer.export(self.config["metricsExportPath"], self.cluster_id)
 
     def stop(self, data):
         """
@@ -1,7 +1,9 @@
 import boto3
 import dku_emr
+import dku_emr_io
+import dku_emr_pool
+import dku_emr_tracing
 import os, json, argparse, logging
-import requests
 from dataiku.cluster import Cluster
 
 # This actually belongs in the main entry point
@@ -16,9 +18,21 @@ class MyCluster(Cluster):
         self.plugin_config = plugin_config
         
     def start(self):
-        region = self.config.get("awsRegionId") or dku_emr.get_current_region()
-        client = dku_emr.get_emr_client(self.config, region)
         release = 'emr-%s' % self.config["emrVersion"]
+        tracer = dku_emr_tracing.PhaseTracer("start", {
+            "release": release,
+            "master_instance_type": self.config.get("masterInstanceType"),
+            "core_instance_type": self.config.get("coreFleetInstanceTypes" if self.config.get("instanceCollectionType") == "INSTANCE_FLEET" else "coreInstanceType")
+        })
+        try:
+            return self._start(tracer, release)
+        finally:
+            self._export_metrics(tracer)
+
+    def _start(self, tracer, release):
+        with tracer.span("get_client"):
+            region = self.config.get("awsRegionId") or dku_emr.get_current_region()
+            client = dku_emr.get_emr_client(self.config, region)
 
         name = "DSS cluster id=%s name=%s" % (self.cluster_id, self.cluster_name)
 
@@ -36,37 +50,60 @@ class MyCluster(Cluster):
         if "additionalSecurityGroups" in self.config:
             security_groups = [x.strip() for x in self.config["additionalSecurityGroups"].split(",")]
 
-        subnet = self.config.get("subnetId") or dku_emr.get_current_subnet()
+        fleet = self.config.get("instanceCollectionType") == "INSTANCE_FLEET"
+        master_count = 3 if self.config.get("multiMaster", False) else 1
 
         instances = {
-                'InstanceGroups': [{
-                    'InstanceRole': 'MASTER',
-                    'InstanceType': self.config["masterInstanceType"],
-                    'InstanceCount': 1
-                }],
                 'KeepJobFlowAliveWhenNoSteps': True,
-                'Ec2SubnetId': subnet,
                 'AdditionalMasterSecurityGroups': security_groups,
                 'AdditionalSlaveSecurityGroups': security_groups
             }
-        
-        if self.config.get("coreInstanceCount"):
-            if not self.config.get("coreInstanceType"):
-                raise Exception("Missing core instance type")
-            instances['InstanceGroups'].append({
-                'InstanceRole': 'CORE',
-                'InstanceType': self.config["coreInstanceType"],
-                'InstanceCount': int(self.config["coreInstanceCount"])
-            })
-
-        if self.config.get("taskInstanceCount"):
-            if not self.config.get("taskInstanceType"):
-                raise Exception("Missing task instance type")
-            instances['InstanceGroups'].append({
-                'InstanceRole': 'TASK',
-                'InstanceType': self.config["taskInstanceType"],
-                'InstanceCount': int(self.config["taskInstanceCount"])
-            })
+
+        if fleet:
+            subnets = [x.strip() for x in self.config.get("subnetIds", "").split(",") if x.strip()]
+            instances['Ec2SubnetIds'] = subnets or [self.config.get("subnetId") or dku_emr.get_current_subnet()]
+
+            spot_args = {
+                "spot_allocation_strategy": self.config.get("spotAllocationStrategy") or "capacity-optimized",
+                "spot_timeout_minutes": self.config.get("spotTimeoutMinutes") or 20,
+                "spot_timeout_action": self.config.get("spotTimeoutAction") or "SWITCH_TO_ON_DEMAND"
+            }
+            instances['InstanceFleets'] = [
+                dku_emr.make_instance_fleet('MASTER', self.config.get("masterFleetInstanceTypes") or self.config["masterInstanceType"], master_count, 0)
+            ]
+            if self.config.get("coreFleetOnDemandCapacity") or self.config.get("coreFleetSpotCapacity"):
+                instances['InstanceFleets'].append(dku_emr.make_instance_fleet('CORE', self.config.get("coreFleetInstanceTypes", ""),
+                        self.config.get("coreFleetOnDemandCapacity"), self.config.get("coreFleetSpotCapacity"),
+                        storage_settings=dku_emr.make_storage_settings(self.config, 'CORE'), **spot_args))
+            if self.config.get("taskFleetOnDemandCapacity") or self.config.get("taskFleetSpotCapacity"):
+                instances['InstanceFleets'].append(dku_emr.make_instance_fleet('TASK', self.config.get("taskFleetInstanceTypes", ""),
+                        self.config.get("taskFleetOnDemandCapacity"), self.config.get("taskFleetSpotCapacity"),
+                        storage_settings=dku_emr.make_storage_settings(self.config, 'TASK'), **spot_args))
+        else:
+            instances['Ec2SubnetId'] = self.config.get("subnetId") or dku_emr.get_current_subnet()
+            instances['InstanceGroups'] = [{
+                    'InstanceRole': 'MASTER',
+                    'InstanceType': self.config["masterInstanceType"],
+                    'InstanceCount': master_count
+                }]
+
+            if self.config.get("coreInstanceCount"):
+                if not self.config.get("coreInstanceType"):
+                    raise Exception("Missing core instance type")
+                instances['InstanceGroups'].append(dict({
+                    'InstanceRole': 'CORE',
+                    'InstanceType': self.config["coreInstanceType"],
+                    'InstanceCount': int(self.config["coreInstanceCount"])
+                }, **dku_emr.make_storage_settings(self.config, 'CORE')))
+
+            if self.config.get("taskInstanceCount"):
+                if not self.config.get("taskInstanceType"):
+                    raise Exception("Missing task instance type")
+                instances['InstanceGroups'].append(dict({
+                    'InstanceRole': 'TASK',
+                    'InstanceType': self.config["taskInstanceType"],
+                    'InstanceCount': int(self.config["taskInstanceCount"])
+                }, **dku_emr.make_storage_settings(self.config, 'TASK')))
 
         if self.config.get("securityConfig"):
             extraArgs["SecurityConfiguration"] = self.config.get("securityConfig")
@@ -97,7 +134,9 @@ class MyCluster(Cluster):
             Configurations = [{"Classification": "hive-site", "Properties" : props}]
             extraArgs["Configurations"] = Configurations
         elif self.config["metastoreDBMode"] == "AWS_GLUE_DATA_CATALOG":
-            account_id = requests.get("http://169.254.169.254/latest/dynamic/instance-identity/document").json()["accountId"]
+            account_id = dku_emr.get_current_account_id()
+            if not account_id:
+                raise Exception("Could not determine the AWS account id for the Glue Data Catalog")
 
             hive_props = {
                 "hive.metastore.client.factory.class": "com.amazonaws.glue.catalog.metastore.AWSGlueDataCatalogHiveClientFactory",
@@ -111,55 +150,73 @@ class MyCluster(Cluster):
                 
             extraArgs["Configurations"] = Configurations
         
-        logging.info("Starting cluster: %s", dict(
-            Name=name,
+        io_configurations = dku_emr_io.make_io_configurations(self.config.get("ioProfile"))
+        if io_configurations:
+            extraArgs["Configurations"] = dku_emr_io.merge_configurations(extraArgs.get("Configurations", []), io_configurations)
+
+        if int(self.config.get("stepConcurrencyLevel") or 1) > 1:
+            extraArgs["StepConcurrencyLevel"] = int(self.config["stepConcurrencyLevel"])
+
+        if self.config.get("customAmiId"):
+            extraArgs["CustomAmiId"] = self.config["customAmiId"]
+
+        bootstrap_actions = dku_emr.make_bootstrap_actions(self.config.get("bootstrapActions", []))
+        if bootstrap_actions:
+            extraArgs["BootstrapActions"] = bootstrap_actions
+
+        fingerprint = None
+        job_flow_name = name
+        if self.config.get("poolMode", False):
+            fingerprint = dku_emr_pool.compute_fingerprint(self.config)
+            with tracer.span("pool_claim"):
+                clusterId = dku_emr_pool.claim_cluster(client, fingerprint, self.cluster_id, tags)
+            if clusterId is not None:
+                try:
+                    return self._make_keys_and_data(client, clusterId, fleet, fingerprint, tracer)
+                except:
+                    # The claim removed the idle timeout: do not leave the cluster behind
+                    logging.warning("could not set up claimed pool cluster %s, terminating it" % clusterId)
+                    client.terminate_job_flows(JobFlowIds=[clusterId])
+                    raise
+            # Nothing to claim: create a cluster that goes to the pool when stopped
+            job_flow_name = dku_emr_pool.make_pool_cluster_name(fingerprint)
+            tags = tags + dku_emr_pool.make_pool_tags(fingerprint, self.cluster_id)
+
+        job_flow = dict(
+            Name=job_flow_name,
             ReleaseLabel=release,
             Instances=instances,
-            Applications=[
-                {"Name": "Hadoop"},
-                {"Name": "Hive"},
-                {"Name": "Tez"},
-                {"Name": "Pig"},
-                {"Name": "Spark"},
-                {"Name": "Zookeeper"}
-            ],
+            Applications=[{"Name": app} for app in dku_emr.get_applications(self.config)],
             VisibleToAllUsers=True,
             JobFlowRole=self.config["nodesRole"],
             ServiceRole=self.config["serviceRole"],
             Tags=tags,
             **extraArgs
-        ))
+        )
+        logging.info("Starting cluster: %s", job_flow)
 
-        response = client.run_job_flow(
-            Name=name,
-            ReleaseLabel=release,
-            Instances=instances,
-            Applications=[
-                {"Name": "Hadoop"},
-                {"Name": "Hive"},
-                {"Name": "Tez"},
-                {"Name": "Pig"},
-                {"Name": "Spark"},
-                {"Name": "Zookeeper"}
-            ],
-            VisibleToAllUsers=True,
-            JobFlowRole=self.config["nodesRole"],
-            ServiceRole=self.config["serviceRole"],
-            Tags=tags,
-            **extraArgs
-         )
+        with tracer.span("run_job_flow"):
+            response = client.run_job_flow(**job_flow)
 
         clusterId = response['JobFlowId']
         logging.info("clusterId=%s" % clusterId)
         
         logging.info("waiting for cluster to start")
         try:
-            client.get_waiter('cluster_running').wait(ClusterId=clusterId)
-            return dku_emr.make_cluster_keys_and_data(client, clusterId, create_user_dir=True, create_databases=self.config.get("databasesToCreate"))
+            with tracer.span("wait_cluster_running"):
+                dku_emr.wait_for_cluster_state(client, clusterId)
+            return self._make_keys_and_data(client, clusterId, fleet, fingerprint, tracer)
         except:
             client.terminate_job_flows(JobFlowIds=[clusterId])
             raise
 
+    def _make_keys_and_data(self, client, clusterId, fleet, fingerprint, tracer):
+        [keys, data] = dku_emr.make_cluster_keys_and_data(client, clusterId, create_user_dir=True, create_databases=self.config.get("databasesToCreate"), fleet=fleet,
+                size_executors=self.config.get("sizeExecutors", False), io_profile=self.config.get("ioProfile"), tracer=tracer)
+        if fingerprint is not None:
+            data["poolFingerprint"] = fingerprint
+        return [keys, data]
+
     def stop(self, data):
         """
         Stop the cluster
@@ -167,7 +224,23 @@ class MyCluster(Cluster):
         :param data: the dict of data that the start() method produced for the cluster
         """
         emrClusterId = data["emrClusterId"]
+        tracer = dku_emr_tracing.PhaseTracer("stop", {"release": 'emr-%s' % self.config.get("emrVersion")})
 
-        region = self.config.get("awsRegionId") or dku_emr.get_current_region()
-        client = dku_emr.get_emr_client(self.config, region)
-        client.terminate_job_flows(JobFlowIds=[emrClusterId])
+        try:
+            with tracer.span("get_client"):
+                region = self.config.get("awsRegionId") or dku_emr.get_current_region()
+                client = dku_emr.get_emr_client(self.config, region)
+            if self.config.get("poolMode", False) and data.get("poolFingerprint"):
+                with tracer.span("pool_release"):
+                    released = dku_emr_pool.release_cluster(client, emrClusterId, self.config, data["poolFingerprint"],
+                            int(self.config.get("poolMaxIdleClusters") or 2), int(self.config.get("poolIdleTtlMinutes") or 60) * 60)
+                if released:
+                    return
+            with tracer.span("terminate_job_flows"):
+                client.terminate_job_flows(JobFlowIds=[emrClusterId])
+        finally:
+            self._export_metrics(tracer)
+
+    def _export_metrics(self, tracer):
+        if self.config.get("metricsExportPath"):
+            tracer.export(self.config["metricsExportPath"], self.cluster_id)
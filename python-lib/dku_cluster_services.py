@@ -0,0 +1,102 @@
+import logging
+import requests
+
+# Ports of the services running on the EMR master node
+RESOURCE_MANAGER_PORT = 8088
+NAMENODE_HTTP_PORT = 9870
+NAMENODE_HTTP_PORT_HADOOP2 = 50070
+HIVESERVER2_WEBUI_PORT = 10002
+
+TIMEOUT = (5, 30)
+
+
+def get_yarn_cluster_metrics(master_address, port=None):
+    """
+    Returns the cluster metrics of the YARN ResourceManager, as a dict with keys like
+    appsPending, containersPending, pendingMB, availableMB, totalMB, activeNodes
+
+    :param port: HTTP port of the ResourceManager, RESOURCE_MANAGER_PORT if None
+    """
+
+    port = port or RESOURCE_MANAGER_PORT
+    url = "http://%s:%s/ws/v1/cluster/metrics" % (master_address, port)
+    logging.info("fetching YARN metrics from %s" % url)
+    response = requests.get(url, headers={"Accept": "application/json"}, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()["clusterMetrics"]
+
+
+def get_hdfs_status(master_address, port):
+    """
+    Returns the capacity and health of HDFS, from the JMX metrics and the configuration of the NameNode
+
+    :param port: the HTTP port of the NameNode, which depends on the Hadoop version
+    :returns: dict with capacityTotal, capacityUsed (bytes), liveDataNodes, underReplicatedBlocks,
+              missingBlocks, replication (the default replication factor) and haState ("active"
+              or "standby", a standby NameNode may report stale figures)
+    """
+
+    url = "http://%s:%s/jmx" % (master_address, port)
+    logging.info("fetching HDFS metrics from %s" % url)
+    response = requests.get(url, params={"qry": "Hadoop:service=NameNode,name=FSNamesystem*"}, timeout=TIMEOUT)
+    response.raise_for_status()
+    beans = {}
+    for bean in response.json()["beans"]:
+        beans.update(bean)
+
+    # The configuration servlet returns JSON when asked to. Older versions ignore the name
+    # filter and return all the properties.
+    response = requests.get("http://%s:%s/conf" % (master_address, port), params={"name": "dfs.replication"},
+                            headers={"Accept": "application/json"}, timeout=TIMEOUT)
+    response.raise_for_status()
+    replication = [p["value"] for p in response.json()["properties"] if p["key"] == "dfs.replication"]
+
+    return {
+        "capacityTotal": beans["CapacityTotal"],
+        "capacityUsed": beans["CapacityUsed"],
+        "liveDataNodes": beans["NumLiveDataNodes"],
+        "underReplicatedBlocks": beans.get("UnderReplicatedBlocks", 0),
+        "missingBlocks": beans.get("MissingBlocks", 0),
+        "replication": int(replication[0]) if replication else 3,
+        "haState": beans.get("tag.HAState", "active")
+    }
+
+
+def get_configuration(master_address, port, prefixes):
+    """
+    Returns the configuration properties of a Hadoop service whose name starts with one of
+    the prefixes, from its configuration servlet
+
+    :param port: the HTTP port of the service, e.g. the NameNode or the ResourceManager
+    :returns: dict of property name -> value
+    """
+
+    url = "http://%s:%s/conf" % (master_address, port)
+    logging.info("fetching configuration from %s" % url)
+    response = requests.get(url, headers={"Accept": "application/json"}, timeout=TIMEOUT)
+    response.raise_for_status()
+    return dict([(p["key"], p["value"]) for p in response.json()["properties"]
+                 if [prefix for prefix in prefixes if p["key"].startswith(prefix)]])
+
+
+def get_hiveserver2_sessions(master_address, port=None):
+    """
+    Returns the number of HiveServer2 sessions, from the metrics of its web UI
+
+    :param port: HTTP port of the HiveServer2 web UI, HIVESERVER2_WEBUI_PORT if None
+    :returns: dict with openSessions and activeSessions (sessions running an operation), or
+              None if HiveServer2 does not report metrics (hive.server2.metrics.enabled)
+    """
+
+    port = port or HIVESERVER2_WEBUI_PORT
+    url = "http://%s:%s/jmx" % (master_address, port)
+    logging.info("fetching HiveServer2 metrics from %s" % url)
+    response = requests.get(url, params={"qry": "metrics:name=hs2_*_sessions"}, timeout=TIMEOUT)
+    response.raise_for_status()
+    values = dict([(bean["name"].split("=")[-1], bean.get("Value", bean.get("Count"))) for bean in response.json()["beans"]])
+    if "hs2_open_sessions" not in values:
+        return None
+    return {
+        "openSessions": int(values["hs2_open_sessions"]),
+        "activeSessions": int(values["hs2_active_sessions"]) if values.get("hs2_active_sessions") is not None else None
+    }
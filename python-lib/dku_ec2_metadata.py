@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import requests
+import tempfile
+import threading
+import time
+
+# Honour the same environment variables as botocore, so that a local stand-in for the
+# metadata service can be used outside of EC2
+METADATA_ENDPOINT = os.environ.get("AWS_EC2_METADATA_SERVICE_ENDPOINT", "http://169.254.169.254").rstrip("/")
+METADATA_DISABLED = os.environ.get("AWS_EC2_METADATA_DISABLED", "false").lower() == "true"
+
+# (connect, read) timeouts in seconds. The metadata service answers in milliseconds on EC2,
+# so anything slower means we are not on EC2 (or the hop limit is too low for IMDSv2)
+TIMEOUT = (1.0, 2.0)
+TOKEN_TTL_SECONDS = 21600
+
+# After the service failed to answer, e.g. outside of EC2, do not try again for this long
+UNAVAILABLE_RETRY_DELAY = 300
+
+IDENTITY_DOCUMENT_CACHE_TTL = 3600
+IDENTITY_DOCUMENT_CACHE_FILE = os.path.join(tempfile.gettempdir(), "dku-emr-instance-identity-%s.json" % os.geteuid())
+
+_lock = threading.Lock()
+_token = None
+_token_expiry = 0
+_identity_document = None
+_unavailable_until = 0
+_token_unavailable_until = 0
+
+
+def get_identity_document():
+    """
+    Returns the instance identity document of the current EC2 instance as a dict, or None
+    if it is not available. The document is fetched once per process and cached on disk.
+    """
+
+    global _identity_document
+    with _lock:
+        if _identity_document is None:
+            _identity_document = _read_cached_identity_document()
+        if _identity_document is None:
+            text = _get("latest/dynamic/instance-identity/document")
+            if text is not None:
+                _identity_document = json.loads(text)
+                _write_cached_identity_document(_identity_document)
+        return _identity_document
+
+
+def get_region():
+    """Returns the AWS region of the current EC2 instance, or None"""
+
+    document = get_identity_document()
+    return document.get("region") if document else None
+
+
+def get_account_id():
+    """Returns the AWS account id of the current EC2 instance, or None"""
+
+    document = get_identity_document()
+    return document.get("accountId") if document else None
+
+
+def get_subnet():
+    """Returns the subnet id of the primary network interface of the current EC2 instance, or None"""
+
+    with _lock:
+        mac = _get("latest/meta-data/mac")
+        if mac is None:
+            return None
+        return _get("latest/meta-data/network/interfaces/macs/%s/subnet-id" % mac)
+
+
+def _get(path):
+    """Fetches a metadata path, using an IMDSv2 token when the service supports it. Returns None on failure."""
+
+    global _unavailable_until
+    if METADATA_DISABLED:
+        logging.info("EC2 metadata service is disabled, not fetching %s" % path)
+        return None
+    if time.time() < _unavailable_until:
+        logging.info("EC2 metadata service did not answer recently, not fetching %s" % path)
+        return None
+
+    start = time.time()
+    try:
+        headers = {}
+        token = _get_token()
+        if token:
+            headers["X-aws-ec2-metadata-token"] = token
+        response = requests.get("%s/%s" % (METADATA_ENDPOINT, path), headers=headers, timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.text
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        # Not on EC2, or the service is unreachable: do not pay the timeouts on every call
+        logging.error("EC2 metadata service unavailable, fetching %s: %s" % (path, e))
+        _unavailable_until = time.time() + UNAVAILABLE_RETRY_DELAY
+        return None
+    except Exception as e:
+        logging.error("could not fetch EC2 metadata %s: %s" % (path, e))
+        return None
+    finally:
+        logging.info("EC2 metadata %s took %.3fs" % (path, time.time() - start))
+
+
+def _get_token():
+    """Returns an IMDSv2 session token, or None to fall back to IMDSv1"""
+
+    global _token, _token_expiry, _token_unavailable_until
+    if _token and time.time() < _token_expiry:
+        return _token
+    if time.time() < _token_unavailable_until:
+        return None
+
+    try:
+        response = requests.put("%s/latest/api/token" % METADATA_ENDPOINT,
+                                headers={"X-aws-ec2-metadata-token-ttl-seconds": str(TOKEN_TTL_SECONDS)},
+                                timeout=TIMEOUT)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        # Like botocore: the token response does not come back through a container on EC2
+        # when the hop limit is 1, while IMDSv1 may still answer. Whether the service is
+        # available at all is decided by the GET.
+        logging.warning("could not get an EC2 metadata token, using IMDSv1: %s" % e)
+        _token_unavailable_until = time.time() + UNAVAILABLE_RETRY_DELAY
+        return None
+    if response.status_code in (403, 404, 405):
+        # IMDSv2 not supported or disabled on this endpoint
+        logging.info("EC2 metadata token not available (HTTP %s), using IMDSv1" % response.status_code)
+        return None
+    response.raise_for_status()
+
+    _token = response.text
+    # Renew well before the actual expiry
+    _token_expiry = time.time() + TOKEN_TTL_SECONDS - 60
+    return _token
+
+
+def _read_cached_identity_document():
+    try:
+        if time.time() - os.path.getmtime(IDENTITY_DOCUMENT_CACHE_FILE) > IDENTITY_DOCUMENT_CACHE_TTL:
+            return None
+        with open(IDENTITY_DOCUMENT_CACHE_FILE) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_cached_identity_document(document):
+    try:
+        tmp = "%s.%s" % (IDENTITY_DOCUMENT_CACHE_FILE, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(document, f)
+        os.rename(tmp, IDENTITY_DOCUMENT_CACHE_FILE)
+    except (IOError, OSError) as e:
+        logging.warning("could not cache EC2 identity document: %s" % e)
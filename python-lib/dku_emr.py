@@ -1,63 +1,678 @@
 import boto3
+import botocore.config
+import botocore.credentials
+import botocore.exceptions
+import botocore.session
 import copy
+import dku_cluster_services
+import dku_ec2_metadata
+import dku_emr_io
+import dku_emr_sizing
+import dku_emr_tracing
 import json
 import logging
 import os
 import pwd
 import requests
 import subprocess
+import threading
+import time
 import traceback
+from multiprocessing.pool import ThreadPool
 
+try:
+    from pyhive import hive
+except ImportError:
+    # Optional, databases are created with beeline without it
+    hive = None
 
-def get_client_and_wait(started_cluster_settings):
+
+def record_worker_nodes(dss_cluster, worker_nodes):
+    """
+    Updates the worker nodes, and the executor cores they allow, in the data of a DSS cluster
+    after a resize. The settings are fetched again so that changes made meanwhile are kept.
+    """
+
+    settings = dss_cluster.get_settings()
+    data = settings.get_plugin_data()
+    if not data:
+        return
+    sizing = dku_emr_sizing.compute_sizing(worker_nodes)
+    data["workerNodes"] = worker_nodes
+    data["totalExecutorCores"] = sizing["totalCores"] if sizing else None
+    settings.save()
+
+
+def get_client_and_wait(started_cluster_settings, max_pool_connections=None):
     """
     Get a Boto client from the :class:`dataikuapi.dss.admin.DSSClusterSettings` of a started DSS cluster
 
+    :param max_pool_connections: optional, overrides the connection pool size of the cluster settings
     :returns: tuple (boto client, emr cluster id)
     """
 
     config = started_cluster_settings.get_raw()["params"]["config"]
+    if max_pool_connections:
+        config = dict(config, maxPoolConnections=max(max_pool_connections, int(config.get("maxPoolConnections") or 0)))
     data = started_cluster_settings.get_plugin_data()
     if data is None:
         raise ValueError("No cluster data, is it stopped/detached?")
 
     region = config.get("awsRegionId") or get_current_region()
-    logging.info("creating Boto client for cluster, region=%s", region)
+    logging.info("getting Boto client for cluster, region=%s", region)
     client = get_emr_client(config, region)
 
     logging.info("waiting for cluster %s to be running" % data["emrClusterId"])
-    waiter = client.get_waiter('cluster_running')
-    waiter.wait(ClusterId=data["emrClusterId"])
+    wait_for_cluster_state(client, data["emrClusterId"])
     logging.info("cluster started")
     return (client, data["emrClusterId"])
 
 
-def make_cluster_keys_and_data(client, cluster_id, create_user_dir=False, create_databases=None):
+# Readiness of clusters. Instead of one DescribeCluster per waiting cluster and per poll,
+# the states of all the active clusters of an account and region are fetched with
+# ListClusters, and shared by all the threads waiting on clusters through the same client.
+# A single waiter uses DescribeCluster, which does not depend on the size of the account.
+
+ACTIVE_CLUSTER_STATES = ['STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING', 'TERMINATING']
+READY_CLUSTER_STATES = ('RUNNING', 'WAITING')
+FAILED_CLUSTER_STATES = ('TERMINATING', 'TERMINATED', 'TERMINATED_WITH_ERRORS')
+READINESS_POLL_INTERVAL = 15
+
+_state_pollers_lock = threading.Lock()
+_state_pollers = {}
+
+
+def wait_for_cluster_state(client, cluster_id, states=READY_CLUSTER_STATES, timeout=1800):
+    """
+    Waits until a cluster reaches one of the given states
+
+    :param states: the states to wait for, running by default
+    :param timeout: timeout in seconds
+    :returns: the state of the cluster
+    :raises Exception: if the cluster terminates before reaching one of the states, or on timeout
+    """
+
+    return get_cluster_state_poller(client).wait(cluster_id, states, timeout=timeout)
+
+
+def get_cluster_state_poller(client):
+    """Returns the :class:`ClusterStatePoller` shared by all the users of a client"""
+
+    with _state_pollers_lock:
+        poller = _state_pollers.get(client)
+        if poller is None:
+            poller = ClusterStatePoller(client)
+            _state_pollers[client] = poller
+        return poller
+
+
+class ClusterStatePoller(object):
+    """
+    Polls the states of many clusters at once. There is no background thread: the first
+    waiting thread that finds the states outdated polls for everyone, the others wait for
+    its result.
+    """
+
+    def __init__(self, client, interval=READINESS_POLL_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.states = {}
+        self.polled_at = 0
+        self.polling = False
+        self.waiting = {}
+
+    def get_state(self, cluster_id, max_age=None):
+        """
+        Returns the state of a cluster, from the last poll if it is recent enough
+
+        :param max_age: maximum age of the last poll, in seconds, defaults to the poll interval
+        :returns: tuple (state, state change reason message)
+        """
+
+        max_age = self.interval if max_age is None else max_age
+        with self.condition:
+            while True:
+                if cluster_id in self.states and time.time() - self.polled_at < max_age:
+                    return self.states[cluster_id]
+                if not self.polling:
+                    self.polling = True
+                    break
+                self.condition.wait()
+
+        states = None
+        try:
+            with self.condition:
+                cluster_ids = set(self.waiting) | set([cluster_id])
+            states = self._poll(cluster_ids)
+        finally:
+            with self.condition:
+                # On failure, another thread polls again
+                if states is not None:
+                    self.states = states
+                    self.polled_at = time.time()
+                self.polling = False
+                self.condition.notify_all()
+        return states[cluster_id]
+
+    def wait(self, cluster_id, states, timeout=1800):
+        """
+        Waits until a cluster reaches one of the given states
+
+        :returns: the state of the cluster
+        :raises Exception: if the cluster terminates before reaching one of the states, or on timeout
+        """
+
+        deadline = time.time() + timeout
+        with self.condition:
+            self.waiting[cluster_id] = self.waiting.get(cluster_id, 0) + 1
+        try:
+            while True:
+                (state, reason) = self.get_state(cluster_id)
+                if state in states:
+                    return state
+                if state in FAILED_CLUSTER_STATES:
+                    raise Exception("EMR cluster %s is %s: %s" % (cluster_id, state, reason))
+                next_poll = self.polled_at + self.interval
+                if next_poll > deadline:
+                    raise Exception("timeout waiting for EMR cluster %s, still %s after %ds" % (cluster_id, state, timeout))
+                time.sleep(max(0, next_poll - time.time()))
+        finally:
+            with self.condition:
+                self.waiting[cluster_id] -= 1
+                if not self.waiting[cluster_id]:
+                    del self.waiting[cluster_id]
+
+    def _poll(self, cluster_ids):
+        states = {}
+        if len(cluster_ids) == 1:
+            # A single waiter, the usual case of macros: one call, whatever the size of the account
+            for cluster_id in cluster_ids:
+                status = self.client.describe_cluster(ClusterId=cluster_id)["Cluster"]["Status"]
+                states[cluster_id] = (status["State"], status.get("StateChangeReason", {}).get("Message"))
+            return states
+
+        for page in self.client.get_paginator("list_clusters").paginate(ClusterStates=ACTIVE_CLUSTER_STATES):
+            for cluster in page["Clusters"]:
+                states[cluster["Id"]] = (cluster["Status"]["State"], cluster["Status"].get("StateChangeReason", {}).get("Message"))
+
+        # Terminated clusters are not listed, and new ones may not be listed yet
+        for cluster_id in cluster_ids - set(states):
+            status = self.client.describe_cluster(ClusterId=cluster_id)["Cluster"]["Status"]
+            states[cluster_id] = (status["State"], status.get("StateChangeReason", {}).get("Message"))
+
+        logging.info("polled the states of %d clusters, %d waited on" % (len(states), len(cluster_ids)))
+        return states
+
+
+def wait_with_backoff(poll, timeout, operation):
+    """
+    Calls poll until it returns something else than None. Polls quickly at first, then
+    backs off, and backs off further when throttled.
+
+    :param operation: what is being waited for, for the messages
+    """
+
+    deadline = time.time() + timeout
+    interval = 5
+    while True:
+        try:
+            result = poll()
+            if result is not None:
+                return result
+            interval = min(interval * 1.5, 60)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("ThrottlingException", "Throttling"):
+                raise
+            interval = min(interval * 2, 120)
+            logging.info("throttled while waiting for %s, polling every %ds" % (operation, interval))
+
+        if time.time() + interval > deadline:
+            raise Exception("timeout waiting for %s to complete after %ds" % (operation, timeout))
+        time.sleep(interval)
+
+
+ACTIVE_INSTANCE_STATES = ['AWAITING_FULFILLMENT', 'PROVISIONING', 'BOOTSTRAPPING', 'RUNNING']
+
+
+def run_in_parallel(*functions):
+    """
+    Calls functions without arguments in parallel threads
+
+    :returns: the list of their results, in order. The first exception raised, if any, is re-raised.
+    """
+
+    pool = ThreadPool(len(functions))
+    try:
+        results = [pool.apply_async(f) for f in functions]
+        return [r.get() for r in results]
+    finally:
+        pool.close()
+
+
+def list_instances(client, cluster_id, node_type, instance_states=ACTIVE_INSTANCE_STATES, fleet=False):
+    """
+    Lists all the instances of a cluster for a node type, following pagination
+
+    :param node_type: MASTER, CORE or TASK
+    :param fleet: whether the cluster uses instance fleets rather than instance groups
+    :returns: list of compact instance records
+    """
+
+    if fleet:
+        filters = {"InstanceFleetType": node_type}
+    else:
+        filters = {"InstanceGroupTypes": [node_type]}
+
+    instances = []
+    paginator = client.get_paginator('list_instances')
+    for page in paginator.paginate(ClusterId=cluster_id, InstanceStates=instance_states, **filters):
+        for inst in page['Instances']:
+            instances.append({
+                "instanceId": inst.get("Ec2InstanceId"),
+                "privateIpAddress": inst.get("PrivateIpAddress"),
+                "privateDnsName": inst.get("PrivateDnsName"),
+                "publicDnsName": inst.get("PublicDnsName"),
+                "instanceType": inst.get("InstanceType"),
+                "market": inst.get("Market"),
+                "state": inst["Status"]["State"],
+                "instanceGroupId": inst.get("InstanceGroupId"),
+                "instanceFleetId": inst.get("InstanceFleetId"),
+                "instanceGroupType": node_type
+            })
+    return instances
+
+
+def list_instance_groups(client, cluster_id):
+    """Lists all the instance groups of a cluster, following pagination"""
+
+    groups = []
+    paginator = client.get_paginator('list_instance_groups')
+    for page in paginator.paginate(ClusterId=cluster_id):
+        groups.extend(page['InstanceGroups'])
+    return groups
+
+
+def list_instance_fleets(client, cluster_id):
+    """Lists all the instance fleets of a cluster, following pagination"""
+
+    fleets = []
+    paginator = client.get_paginator('list_instance_fleets')
+    for page in paginator.paginate(ClusterId=cluster_id):
+        fleets.extend(page['InstanceFleets'])
+    return fleets
+
+
+def is_instance_fleet_cluster(client, cluster_id, cluster_config=None):
+    """Returns whether a cluster uses instance fleets, from the DSS cluster config when it says so, else from EMR"""
+
+    if cluster_config and cluster_config.get("instanceCollectionType"):
+        return cluster_config["instanceCollectionType"] == "INSTANCE_FLEET"
+    cluster = client.describe_cluster(ClusterId=cluster_id)["Cluster"]
+    return cluster.get("InstanceCollectionType") == "INSTANCE_FLEET"
+
+
+def list_worker_nodes(client, cluster_id, fleet=False):
+    """
+    Lists the instance types and requested counts of the CORE and TASK nodes. For fleets,
+    counts are estimated from the target capacity and the smallest weighted instance type.
+
+    :returns: list of dicts with nodeType, instanceType and count
+    """
+
+    nodes = []
+    if fleet:
+        for f in list_instance_fleets(client, cluster_id):
+            specs = f.get("InstanceTypeSpecifications", [])
+            if f["InstanceFleetType"] in ("CORE", "TASK") and specs:
+                spec = sorted(specs, key=lambda x: x.get("WeightedCapacity", 1))[0]
+                capacity = f.get("TargetOnDemandCapacity", 0) + f.get("TargetSpotCapacity", 0)
+                nodes.append({"nodeType": f["InstanceFleetType"], "instanceType": spec["InstanceType"],
+                              "count": -(-capacity // spec.get("WeightedCapacity", 1))})
+    else:
+        for g in list_instance_groups(client, cluster_id):
+            if g["InstanceGroupType"] in ("CORE", "TASK"):
+                nodes.append({"nodeType": g["InstanceGroupType"], "instanceType": g["InstanceType"], "count": g["RequestedInstanceCount"]})
+    return nodes
+
+
+def get_cluster_inventory(client, cluster_id, fleet=False):
+    """
+    Builds the complete inventory of the instances and instance groups (or fleets) of a
+    cluster, and finds its active master. The queries for each node type run concurrently.
+    """
+
+    if fleet:
+        list_collections = lambda: list_instance_fleets(client, cluster_id)
+    else:
+        list_collections = lambda: list_instance_groups(client, cluster_id)
+
+    (cluster, master_instances, core_instances, task_instances, collections) = run_in_parallel(
+        lambda: client.describe_cluster(ClusterId=cluster_id)['Cluster'],
+        lambda: list_instances(client, cluster_id, 'MASTER', fleet=fleet),
+        lambda: list_instances(client, cluster_id, 'CORE', fleet=fleet),
+        lambda: list_instances(client, cluster_id, 'TASK', fleet=fleet),
+        list_collections)
+
+    inventory = {
+        "masterInstance": _find_active_master(cluster, master_instances) if master_instances else None,
+        "masterInstances": master_instances,
+        "slaveInstances": core_instances + task_instances
+    }
+    if fleet:
+        inventory["instanceFleets"] = [
+                {"instanceFleetId" : x["Id"],
+                 "instanceFleetType" : x["InstanceFleetType"],
+                 "targetOnDemandCapacity": x.get("TargetOnDemandCapacity", 0),
+                 "targetSpotCapacity": x.get("TargetSpotCapacity", 0),
+                 "provisionedOnDemandCapacity": x.get("ProvisionedOnDemandCapacity", 0),
+                 "provisionedSpotCapacity": x.get("ProvisionedSpotCapacity", 0),
+                 "instanceTypes": [t["InstanceType"] for t in x.get("InstanceTypeSpecifications", [])],
+                 "status": x["Status"]["State"]
+                } for x in collections]
+    else:
+        inventory["instanceGroups"] = [
+                {"instanceGroupId" : x["Id"],
+                 "requestedInstanceCount": x.get("RequestedInstanceCount"),
+                 "runningInstanceCount": x["RunningInstanceCount"],
+                 "instanceType" : x["InstanceType"],
+                 "instanceGroupType" : x["InstanceGroupType"],
+                 "market": x.get("Market"),
+                 "status": x["Status"]["State"]
+                } for x in collections]
+    return inventory
+
+
+DEFAULT_APPLICATIONS = ["Hadoop", "Hive", "Tez", "Pig", "Spark", "Zookeeper"]
+
+
+def get_applications(config):
+    """
+    Returns the names of the EMR applications to install, from the DSS cluster config. Hadoop
+    is always installed. The defaults only apply to configs without the setting (saved
+    before it existed): an empty selection means Hadoop only.
+    """
+
+    applications = config.get("applications")
+    if applications is None:
+        applications = DEFAULT_APPLICATIONS
+    return ["Hadoop"] + [app for app in applications if app != "Hadoop"]
+
+
+def has_application(applications, name):
+    """Returns whether an application is in a list of EMR application names"""
+
+    return name.lower() in [app.lower() for app in applications]
+
+
+def make_bootstrap_actions(actions):
+    """
+    Builds the bootstrap actions of a cluster
+
+    :param actions: list of {"from": S3 path of the script, "to": space-separated arguments}, as in the DSS cluster config
+    """
+
+    bootstrap_actions = []
+    for (i, action) in enumerate(actions):
+        if not action.get("from"):
+            continue
+        bootstrap_actions.append({
+            "Name": "DSS bootstrap action %d: %s" % (i + 1, action["from"].split("/")[-1]),
+            "ScriptBootstrapAction": {"Path": action["from"], "Args": (action.get("to") or "").split()}
+        })
+    return bootstrap_actions
+
+
+EBS_VOLUME_TYPES_WITH_IOPS = ("gp3", "io1", "io2")
+
+
+def make_storage_settings(config, node_type):
+    """
+    Builds the EBS data volumes of the CORE or TASK nodes from the DSS cluster config. EMR
+    spreads the local dirs of the Hadoop daemons over all the mounted volumes, instance store
+    included.
+
+    :returns: dict with EbsConfiguration, to add to an instance group or to the instance type
+              configs of an instance fleet. Empty to keep the EMR defaults.
+    """
+
+    prefix = node_type.lower()
+    count = int(config.get("%sEbsVolumeCount" % prefix) or 0)
+    if not count:
+        return {}
+    if not config.get("%sEbsVolumeSize" % prefix):
+        raise Exception("Missing EBS volume size for %s nodes" % node_type)
+
+    volume_type = config.get("%sEbsVolumeType" % prefix) or "gp3"
+    volume = {"VolumeType": volume_type, "SizeInGB": int(config["%sEbsVolumeSize" % prefix])}
+    if volume_type in EBS_VOLUME_TYPES_WITH_IOPS and config.get("%sEbsIops" % prefix):
+        volume["Iops"] = int(config["%sEbsIops" % prefix])
+    if volume_type == "gp3" and config.get("%sEbsThroughput" % prefix):
+        volume["Throughput"] = int(config["%sEbsThroughput" % prefix])
+
+    return {
+        "EbsConfiguration": {
+            "EbsBlockDeviceConfigs": [{"VolumeSpecification": volume, "VolumesPerInstance": count}],
+            "EbsOptimized": bool(config.get("%sEbsOptimized" % prefix, True))
+        }
+    }
+
+
+def make_instance_fleet(node_type, instance_types, on_demand_capacity, spot_capacity,
+                        spot_allocation_strategy="capacity-optimized", spot_timeout_minutes=20, spot_timeout_action="SWITCH_TO_ON_DEMAND",
+                        storage_settings=None):
+    """
+    Builds an instance fleet definition for run_job_flow or add_instance_fleet
+
+    :param instance_types: comma-separated instance types, each optionally followed by
+                           its weighted capacity, e.g. "m5.2xlarge:2,r5.xlarge:1"
+    :param storage_settings: optional, the storage settings of each instance type, from :func:`make_storage_settings`
+    """
+
+    type_configs = []
+    for spec in [x.strip() for x in instance_types.split(",") if x.strip()]:
+        if ":" in spec:
+            (instance_type, weight) = spec.split(":", 1)
+            type_configs.append({"InstanceType": instance_type.strip(), "WeightedCapacity": int(weight)})
+        else:
+            type_configs.append({"InstanceType": spec, "WeightedCapacity": 1})
+    if not type_configs:
+        raise Exception("Missing instance types for %s fleet" % node_type)
+    for type_config in type_configs:
+        type_config.update(copy.deepcopy(storage_settings or {}))
+
+    fleet = {
+        "Name": "%s fleet" % node_type.capitalize(),
+        "InstanceFleetType": node_type,
+        "TargetOnDemandCapacity": int(on_demand_capacity or 0),
+        "TargetSpotCapacity": int(spot_capacity or 0),
+        "InstanceTypeConfigs": type_configs
+    }
+    if fleet["TargetSpotCapacity"]:
+        fleet["LaunchSpecifications"] = {
+            "SpotSpecification": {
+                "TimeoutDurationMinutes": int(spot_timeout_minutes),
+                "TimeoutAction": spot_timeout_action,
+                "AllocationStrategy": spot_allocation_strategy
+            }
+        }
+    return fleet
+
+
+def discover_cluster(client, cluster_id, fleet=None):
+    """
+    Looks up a cluster and its master nodes. The calls run concurrently and follow pagination.
+
+    :param fleet: whether the cluster uses instance fleets, None if unknown
+    :returns: a dict with the cluster description, the master instances, the address of the active master
+              and the instance types and counts of the worker nodes
+    """
+
+    def list_masters():
+        try:
+            return list_instances(client, cluster_id, 'MASTER', fleet=bool(fleet))
+        except botocore.exceptions.ClientError:
+            if fleet is not None:
+                raise
+            return None
+
+    def list_workers():
+        try:
+            return list_worker_nodes(client, cluster_id, fleet=bool(fleet))
+        except botocore.exceptions.ClientError:
+            if fleet is not None:
+                raise
+            return None
 
     logging.info("looking up cluster %s" % cluster_id)
-    master_instance = None
-    response = client.list_instances(ClusterId=cluster_id,
-                InstanceGroupTypes=['MASTER'],
-                InstanceStates=['AWAITING_FULFILLMENT', 'PROVISIONING', 'BOOTSTRAPPING', 'RUNNING'])
-    #raise Exception("ALL INSTANCES: %s"  % json.dumps(response))
-    for inst in response['Instances']:
-        h = inst['PrivateIpAddress']
-        master_instance = h
-        logging.info("master instance address: %s" % h)
-
-    # slave_instances_info = []
-    # response = client.list_instances(ClusterId=cluster_id,
-    #         InstanceGroupTypes=['CORE', 'TASK'],
-    #         InstanceStates=['AWAITING_FULFILLMENT', 'PROVISIONING', 'BOOTSTRAPPING', 'RUNNING'])
-    # for inst in response['Instances']:
-    #     slave_instances_info.append({"privateIpAddress":  inst["PrivateIpAddress"]})
+    (cluster, master_instances, worker_nodes) = run_in_parallel(
+        lambda: client.describe_cluster(ClusterId=cluster_id)['Cluster'],
+        list_masters,
+        list_workers)
+
+    is_fleet = cluster.get("InstanceCollectionType") == "INSTANCE_FLEET"
+    if fleet is None and (master_instances is None or is_fleet):
+        # Guessed wrong, masters of fleet clusters are filtered by fleet type
+        master_instances = list_instances(client, cluster_id, 'MASTER', fleet=is_fleet)
+    if fleet is None and (worker_nodes is None or is_fleet):
+        worker_nodes = list_worker_nodes(client, cluster_id, fleet=is_fleet)
+
+    active_master = _find_active_master(cluster, master_instances)
+    logging.info("master instance address: %s (%d master instances)" % (active_master["privateIpAddress"], len(master_instances)))
+
+    return {
+        "clusterId": cluster_id,
+        "cluster": cluster,
+        "masterInstances": master_instances,
+        "masterAddress": active_master["privateIpAddress"],
+        "workerNodes": worker_nodes,
+        "applications": [app["Name"] for app in cluster.get("Applications", [])],
+        "configurations": cluster.get("Configurations", [])
+    }
+
+
+def _find_active_master(cluster, master_instances):
+    """
+    The master DNS name of the cluster designates the active master, which matters on
+    multi-master clusters. It is the private DNS name for clusters in private subnets.
+    """
+
+    if not master_instances:
+        raise Exception("No running master instance found in cluster %s (state %s)" % (cluster["Id"], cluster["Status"]["State"]))
+
+    master_dns_name = cluster.get("MasterPublicDnsName")
+    if master_dns_name:
+        for inst in master_instances:
+            if master_dns_name in (inst["privateDnsName"], inst["publicDnsName"], inst["privateIpAddress"]):
+                return inst
+        logging.warning("no master instance matches master DNS name %s" % master_dns_name)
+
+    # Deterministic fallback: prefer running instances
+    return sorted(master_instances, key=lambda inst: (inst["state"] != "RUNNING", inst["instanceId"]))[0]
+
+
+# Client-side HA properties of multi-master clusters, as set by EMR on the masters
+HA_HDFS_PREFIXES = ["dfs.nameservices", "dfs.ha.namenodes.", "dfs.namenode.rpc-address.", "dfs.client.failover.proxy.provider."]
+HA_YARN_PREFIXES = ["yarn.resourcemanager.ha.", "yarn.resourcemanager.cluster-id", "yarn.resourcemanager.hostname.",
+                    "yarn.resourcemanager.address.", "yarn.resourcemanager.scheduler.address."]
+# Properties that point at a single ResourceManager, replaced by the HA properties.
+# yarn.resourcemanager.hostname stays on the active master, EMRFS requires it.
+SINGLE_RM_KEYS = ["yarn.resourcemanager.address", "yarn.resourcemanager.scheduler.address"]
+
+
+def get_ha_configuration(discovery):
+    """
+    Reads the HDFS nameservice and the YARN ResourceManager HA settings of a multi-master
+    cluster from its NameNode and ResourceManager. EMR chooses the nameservice, the
+    NameNodes (2 on Hadoop 2, 3 on Hadoop 3) and the ResourceManager ids.
+
+    :returns: dict with the nameservice and the HA properties for clients, or None if the
+              cluster is not HA or its configuration could not be read
+    """
+
+    master = discovery["masterAddress"]
+    try:
+        (hdfs_conf, yarn_conf) = run_in_parallel(
+            lambda: dku_cluster_services.get_configuration(master, get_namenode_http_port(discovery["cluster"].get("ReleaseLabel")), HA_HDFS_PREFIXES),
+            lambda: dku_cluster_services.get_configuration(master, dku_cluster_services.RESOURCE_MANAGER_PORT, HA_YARN_PREFIXES))
+    except Exception as e:
+        logging.warning("could not read the HA configuration of the cluster, using the active master only: %s" % e)
+        return None
+
+    nameservice = hdfs_conf.get("dfs.nameservices", "").split(",")[0].strip()
+    namenodes = [nn.strip() for nn in hdfs_conf.get("dfs.ha.namenodes.%s" % nameservice, "").split(",") if nn.strip()]
+    rm_ids = [rm.strip() for rm in yarn_conf.get("yarn.resourcemanager.ha.rm-ids", "").split(",") if rm.strip()]
+    if not nameservice or not namenodes or yarn_conf.get("yarn.resourcemanager.ha.enabled") != "true" or not rm_ids:
+        logging.warning("cluster has %d masters but no HDFS nameservice or YARN HA, using the active master only" % len(discovery["masterInstances"]))
+        return None
+
+    properties = [
+        ("dfs.nameservices", nameservice),
+        ("dfs.ha.namenodes.%s" % nameservice, ",".join(namenodes)),
+        ("dfs.client.failover.proxy.provider.%s" % nameservice, hdfs_conf.get("dfs.client.failover.proxy.provider.%s" % nameservice,
+                "org.apache.hadoop.hdfs.server.namenode.ha.ConfiguredFailoverProxyProvider"))
+    ]
+    namenode_addresses = [hdfs_conf.get("dfs.namenode.rpc-address.%s.%s" % (nameservice, nn)) for nn in namenodes]
+    if None in namenode_addresses:
+        logging.warning("no RPC address for some namenodes of nameservice %s, using the active master only" % nameservice)
+        return None
+    properties.extend([("dfs.namenode.rpc-address.%s.%s" % (nameservice, nn), address) for (nn, address) in zip(namenodes, namenode_addresses)])
+    properties.append(("yarn.resourcemanager.ha.enabled", "true"))
+    properties.append(("yarn.resourcemanager.ha.rm-ids", ",".join(rm_ids)))
+    if "yarn.resourcemanager.cluster-id" in yarn_conf:
+        properties.append(("yarn.resourcemanager.cluster-id", yarn_conf["yarn.resourcemanager.cluster-id"]))
+    for rm in rm_ids:
+        for key in ["yarn.resourcemanager.hostname", "yarn.resourcemanager.address", "yarn.resourcemanager.scheduler.address"]:
+            if "%s.%s" % (key, rm) in yarn_conf:
+                properties.append(("%s.%s" % (key, rm), yarn_conf["%s.%s" % (key, rm)]))
+
+    logging.info("cluster is HA: nameservice %s with namenodes %s, resource managers %s" % (nameservice, namenode_addresses, rm_ids))
+    return {
+        "nameservice": nameservice,
+        "namenodeHosts": [address.split(":")[0] for address in namenode_addresses],
+        "properties": properties
+    }
+
+
+def _apply_ha_configuration(overrides, ha_configuration, prefix=""):
+    """Points DSS settings overrides at the HDFS nameservice and the ResourceManagers of an HA cluster, in place"""
+
+    single_rm_keys = [prefix + key for key in SINGLE_RM_KEYS]
+    overrides[:] = [o for o in overrides if o["key"] not in single_rm_keys]
+    for override in overrides:
+        if override["key"] == prefix + "fs.defaultFS":
+            override["value"] = "hdfs://%s" % ha_configuration["nameservice"]
+    overrides.extend([{"key": prefix + key, "value": value} for (key, value) in ha_configuration["properties"]])
+
+
+def make_cluster_keys_and_data(client, cluster_id, create_user_dir=False, create_databases=None, discovery=None, fleet=None, size_executors=False,
+                               io_profile=None, tracer=None):
+    """
+    Builds the DSS cluster settings and the cluster data for an EMR cluster
+
+    :param discovery: the result of :func:`discover_cluster`, looked up if not given
+    :param fleet: whether the cluster uses instance fleets, None if unknown
+    :param size_executors: whether to size Spark executors and Tez containers after the instance types of the cluster
+    :param io_profile: name of the S3 I/O profile of :mod:`dku_emr_io` to apply to the DSS settings, if any
+    :param tracer: the :class:`dku_emr_tracing.PhaseTracer` of the calling operation, if any
+    :returns: list [settings keys, cluster data]
+    """
+
+    if tracer is None:
+        tracer = dku_emr_tracing.PhaseTracer("attach")
+    if discovery is None:
+        with tracer.span("discovery"):
+            discovery = discover_cluster(client, cluster_id, fleet=fleet)
+    tracer.add_emr_timeline(discovery["cluster"])
+    master_instance = discovery["masterAddress"]
+    hive_installed = has_application(discovery["applications"], "Hive")
+    spark_installed = has_application(discovery["applications"], "Spark")
 
     # Look for a custom metastore client factory for Glue-based metastore
     metastoreClientFactoryClass = None
-    response = client.describe_cluster(ClusterId=cluster_id)
-    for conf in response['Cluster']['Configurations']:
+    for conf in discovery["configurations"]:
         if conf['Classification'] == "hive-site":
-            for k, v in conf['Properties'].iteritems():
+            for k, v in conf.get('Properties', {}).items():
                 if k == "hive.metastore.client.factory.class":
                     metastoreClientFactoryClass = v
 
@@ -74,7 +689,7 @@ def make_cluster_keys_and_data(client, cluster_id, create_user_dir=False, create
         ]
     }
     hive_keys = {
-        "enabled": True,
+        "enabled": hive_installed,
         "hiveServer2Host" : master_instance,
         "executionConfigsGenericOverrides" : [
            {"key": "fs.defaultFS", "value" : "hdfs://%s:8020" % master_instance},
@@ -91,92 +706,392 @@ def make_cluster_keys_and_data(client, cluster_id, create_user_dir=False, create
         "enabled": False
     }
     spark_keys = {
-        "sparkEnabled":  True,
+        "sparkEnabled":  spark_installed,
         "executionConfigsGenericOverrides" : [
            {"key": "spark.hadoop.fs.defaultFS", "value" : "hdfs://%s:8020" % master_instance},
            {"key": "spark.hadoop.yarn.resourcemanager.address" , "value" :  "%s:8032" % master_instance},
            {"key": "spark.hadoop.yarn.resourcemanager.scheduler.address" , "value" :  "%s:8030" % master_instance},
-           {"key": "spark.hadoop.hive.metastore.uris" , "value" :  "thrift://%s:9083" % master_instance},
            {"key": "spark.hadoop.yarn.web-proxy.address", "value": "%s:20888" % master_instance},
            {"key": "spark.yarn.historyServer.address", "value": "%s:18080" % master_instance},
            {"key": "spark.eventLog.dir" , "value" :  "hdfs:///var/log/spark/apps"}
         ]
     }
+    if hive_installed:
+        spark_keys["executionConfigsGenericOverrides"].insert(3,
+                {"key": "spark.hadoop.hive.metastore.uris" , "value" :  "thrift://%s:9083" % master_instance}
+            )
     if metastoreClientFactoryClass:
         spark_keys["executionConfigsGenericOverrides"].append(
                 {"key": "spark.hadoop.hive.metastore.client.factory.class", "value": metastoreClientFactoryClass}
             )
 
+    io_overrides = dku_emr_io.get_io_overrides(io_profile)
+    hadoop_keys["extraConf"].extend(io_overrides["hadoop"])
+    spark_keys["executionConfigsGenericOverrides"].extend(io_overrides["spark"])
+
+    sizing = None
+    if size_executors:
+        sizing = dku_emr_sizing.compute_sizing(discovery["workerNodes"])
+        if sizing:
+            spark_keys["executionConfigsGenericOverrides"].extend(sizing["spark"])
+            hive_keys["executionConfigsGenericOverrides"].extend(sizing["hive"])
+
+    ha_configuration = None
+    if len(discovery["masterInstances"]) > 1:
+        with tracer.span("ha_configuration"):
+            ha_configuration = get_ha_configuration(discovery)
+    if ha_configuration:
+        _apply_ha_configuration(hadoop_keys["extraConf"], ha_configuration)
+        _apply_ha_configuration(hive_keys["executionConfigsGenericOverrides"], ha_configuration)
+        _apply_ha_configuration(spark_keys["executionConfigsGenericOverrides"], ha_configuration, "spark.hadoop.")
+        if hive_installed:
+            # The Hive metastore runs on all the masters
+            for override in spark_keys["executionConfigsGenericOverrides"]:
+                if override["key"] == "spark.hadoop.hive.metastore.uris":
+                    override["value"] = ",".join(["thrift://%s:9083" % inst["privateIpAddress"] for inst in discovery["masterInstances"]])
+
+    def traced(name, f):
+        def run():
+            with tracer.span(name):
+                f()
+        return run
+
+    setup_tasks = []
     if create_user_dir:
         username = pwd.getpwuid(os.geteuid()).pw_name
-        homedir = "hdfs://%s:8020/user/%s" % (master_instance, username)
-        logging.info("creating home directory %s" % homedir)
-        env = copy.deepcopy(os.environ)
-        # Group 'hadoop' is in dfs.permissions.superusergroup on EMR
-        env["HADOOP_USER_NAME"] = "hadoop"
-        subprocess.check_call(["hdfs", "dfs", "-mkdir", "-p", homedir], env=env)
-        subprocess.check_call(["hdfs", "dfs", "-chown", username, homedir], env=env)
-
-    if create_databases:
+        namenode_hosts = ha_configuration["namenodeHosts"] if ha_configuration else None
+        setup_tasks.append(traced("hdfs_home_dir", lambda: create_hdfs_home_dir(master_instance, username, discovery["cluster"].get("ReleaseLabel"),
+                namenode_hosts=namenode_hosts)))
+    if create_databases and not hive_installed:
+        logging.warning("Hive is not installed on the cluster, not creating databases %s" % create_databases)
+    elif create_databases:
         dbs = [ db.strip() for db in create_databases.split(',') if db.strip() ]
         if dbs:
-            logging.info("creating hive databases %s" % dbs)
-            subprocess.check_call(["beeline", "-u", "jdbc:hive2://%s:10000" % master_instance, "-e",
-                    ' '.join([ 'create database if not exists `%s`;' % db for db in dbs ])
-                ])
-                
+            setup_tasks.append(traced("hive_databases", lambda: create_hive_databases(master_instance, dbs)))
+    if setup_tasks:
+        run_in_parallel(*setup_tasks)
+
     logging.info("done attaching cluster")
 
     return [{'hadoop':hadoop_keys, 'hive':hive_keys, 'impala':impala_keys, 'spark':spark_keys}, {
-        "emrClusterId":  cluster_id
+        "emrClusterId":  cluster_id,
+        "masterAddress": master_instance,
+        "masterAddresses": [inst["privateIpAddress"] for inst in discovery["masterInstances"]],
+        "hdfsNameservice": ha_configuration["nameservice"] if ha_configuration else None,
+        "workerNodes": discovery["workerNodes"],
+        "totalExecutorCores": sizing["totalCores"] if sizing else None,
+        "timings": tracer.summary()
     }]
 
 
+HIVESERVER2_PORT = 10000
+
+
+def create_hdfs_home_dir(master_instance, username, release_label=None, namenode_hosts=None):
+    """
+    Creates the HDFS home directory of a user through WebHDFS, falling back to the hdfs
+    command line (which needs a Hadoop client on the DSS host) if WebHDFS is not usable,
+    e.g. on kerberized clusters
+
+    :param namenode_hosts: hosts of the NameNodes of an HA cluster, only the active one accepts the operations
+    """
+
+    port = get_namenode_http_port(release_label)
+    homedir = "/user/%s" % username
+    hosts = namenode_hosts or [master_instance]
+    for host in hosts:
+        logging.info("creating home directory %s on %s" % (homedir, host))
+        try:
+            # Group 'hadoop' is in dfs.permissions.superusergroup on EMR
+            _webhdfs_put(host, port, homedir, {"op": "MKDIRS", "user.name": "hadoop"})
+            _webhdfs_put(host, port, homedir, {"op": "SETOWNER", "owner": username, "user.name": "hadoop"})
+            return
+        except Exception as e:
+            logging.warning("could not create home directory through WebHDFS on %s: %s" % (host, e))
+
+    logging.info("falling back to hdfs command")
+    env = copy.deepcopy(os.environ)
+    env["HADOOP_USER_NAME"] = "hadoop"
+    for (i, host) in enumerate(hosts):
+        homedir = "hdfs://%s:8020/user/%s" % (host, username)
+        try:
+            subprocess.check_call(["hdfs", "dfs", "-mkdir", "-p", homedir], env=env)
+            subprocess.check_call(["hdfs", "dfs", "-chown", username, homedir], env=env)
+            return
+        except subprocess.CalledProcessError:
+            if i == len(hosts) - 1:
+                raise
+
+
+def get_namenode_http_port(release_label):
+    """Returns the HTTP port of the HDFS namenode: 9870 from EMR 6 (Hadoop 3), 50070 before"""
+
+    if release_label and release_label.startswith("emr-") and release_label[4:].split(".")[0].isdigit():
+        if int(release_label[4:].split(".")[0]) < 6:
+            return dku_cluster_services.NAMENODE_HTTP_PORT_HADOOP2
+    return dku_cluster_services.NAMENODE_HTTP_PORT
+
+
+def _webhdfs_put(host, port, path, params):
+    response = requests.put("http://%s:%s/webhdfs/v1%s" % (host, port, path), params=params, timeout=(5, 30))
+    response.raise_for_status()
+    # Only MKDIRS has a result, SETOWNER answers with an empty body
+    if params["op"] == "MKDIRS" and response.json().get("boolean") is False:
+        raise Exception("WebHDFS operation %s failed on %s" % (params["op"], path))
+
+
+def create_hive_databases(master_instance, dbs):
+    """
+    Creates Hive databases in a single HiveServer2 session, falling back to beeline if
+    PyHive is not installed or the native connection fails, e.g. on kerberized clusters
+    """
+
+    statements = ['create database if not exists `%s`' % db for db in dbs]
+    logging.info("creating hive databases %s" % dbs)
+    if hive is not None:
+        try:
+            connection = hive.connect(host=master_instance, port=HIVESERVER2_PORT)
+            try:
+                cursor = connection.cursor()
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.close()
+            finally:
+                connection.close()
+            return
+        except Exception as e:
+            logging.warning("could not create databases through HiveServer2, falling back to beeline: %s" % e)
+
+    subprocess.check_call(["beeline", "-u", "jdbc:hive2://%s:%s" % (master_instance, HIVESERVER2_PORT), "-e",
+            ' '.join([ '%s;' % statement for statement in statements ])
+        ])
+
+
 def get_current_region():
     """Returns the AWS region of the calling process, if available, else None"""
 
-    try:
-        return requests.get("http://169.254.169.254/latest/dynamic/instance-identity/document").json()['region']
-    except:
+    region = dku_ec2_metadata.get_region()
+    if region is None:
         logging.error("could not retrieve current AWS region")
-        traceback.print_exc()
-        return None
+    return region
 
 
 def get_current_subnet():
     """Returns the EC2 subnet of the calling process, if available, else None"""
 
-    try:
-        mac = requests.get("http://169.254.169.254/latest/meta-data/mac").text
-        return requests.get("http://169.254.169.254/latest/meta-data/network/interfaces/macs/%s/subnet-id" % mac).text
-    except:
+    subnet = dku_ec2_metadata.get_subnet()
+    if subnet is None:
         logging.error("could not retrieve current EC2 subnet")
-        traceback.print_exc()
-        return None
+    return subnet
+
+
+def get_current_account_id():
+    """Returns the AWS account id of the calling process, if available, else None"""
+
+    account_id = dku_ec2_metadata.get_account_id()
+    if account_id is None:
+        logging.error("could not retrieve current AWS account id")
+    return account_id
 
 
 def get_emr_client(config, region):
-    """Returns a boto3 EMR client object"""
+    """Returns a boto3 EMR client object, shared with other callers using the same region and credentials"""
+
+    return get_client("emr", config, region)
+
+
+# Process-wide cache of boto3 sessions and clients. Building a client means loading the
+# endpoint and service models, and assuming a role costs an STS round-trip, so both are
+# kept for the lifetime of the process. Assumed-role credentials refresh themselves
+# before they expire.
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+# Adaptive mode retries throttled calls with backoff, and slows down the client itself
+# when it gets throttled
+DEFAULT_RETRY_CONFIG = {"mode": "adaptive", "max_attempts": 10}
+ASSUME_ROLE_SESSION_NAME = "dss-emr-access"
+
+_sessions_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_rate_limiters_lock = threading.Lock()
+_rate_limiters = {}
+_session_stats = {"sessions": 0, "clients": 0, "stsCalls": 0, "cacheHits": 0}
+
 
+def get_client(service_name, config, region):
+    """
+    Returns a boto3 client for a service, reusing a cached one when possible
+
+    :param config: the DSS cluster config, for the credentials and connection pool settings
+    :param region: the AWS region
+    """
+
+    max_pool_connections = int(config.get("maxPoolConnections") or DEFAULT_MAX_POOL_CONNECTIONS)
+    key = _get_session_key(config, region)
+    client_key = (key, service_name, max_pool_connections)
+
+    with _sessions_lock:
+        client = _clients.get(client_key)
+        if client is not None:
+            _session_stats["cacheHits"] += 1
+            return client
+
+        session = _sessions.get(key)
+        if session is None:
+            session = _make_session(config, region)
+            _sessions[key] = session
+            _session_stats["sessions"] += 1
+
+        logging.info("creating %s client, region=%s" % (service_name, region))
+        client = session.client(service_name, config=botocore.config.Config(max_pool_connections=max_pool_connections,
+                                                                            retries=DEFAULT_RETRY_CONFIG))
+        client.meta.events.register("before-call", _get_rate_limiter(config, region).before_call)
+        _clients[client_key] = client
+        _session_stats["clients"] += 1
+        return client
+
+
+def get_session_stats():
+    """Returns the counters of the session cache: sessions and clients created, STS calls and cache hits"""
+
+    with _sessions_lock:
+        return dict(_session_stats)
+
+
+def clear_session_cache():
+    """Forgets all the cached sessions, clients, rate limiters and cluster states"""
+
+    with _sessions_lock:
+        _sessions.clear()
+        _clients.clear()
+        _rate_limiters.clear()
+    with _state_pollers_lock:
+        _state_pollers.clear()
+
+
+def set_rate_limit(config, region, calls_per_second, burst=None):
+    """
+    Limits the rate of the AWS API calls made by all the clients of a region and account,
+    which share the same API rate limits on the AWS side
+
+    :param calls_per_second: sustained rate, None for no limit
+    :param burst: number of calls that can be made at once after a pause, defaults to the rate
+    """
+
+    _get_rate_limiter(config, region).set_rate(calls_per_second, burst)
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter, shared by threads. Without a rate, it does not limit anything.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.rate = self.burst = 0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        rate = float(rate) if rate else None
+        burst = float(burst or rate or 1)
+        with self.lock:
+            if (self.rate, self.burst) == (rate, burst):
+                # Already set, e.g. by another thread working in the same account
+                return
+            self.rate = rate
+            self.burst = burst
+            self.tokens = burst
+            self.last = time.time()
+
+    def acquire(self):
+        """Blocks until a call can be made. Returns the time waited, in seconds."""
+
+        waited = 0
+        while True:
+            with self.lock:
+                if self.rate is None:
+                    return waited
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def before_call(self, **kwargs):
+        # botocore event handler
+        self.acquire()
+
+
+def _get_rate_limiter(config, region):
+    # AWS API rate limits apply per account and region. The account of an assumed role is
+    # in its ARN; other credentials are assumed to each belong to their own account.
+    (region, role, access_key) = _get_session_key(config, region)
+    key = (region, role.split(":")[4] if role and role.startswith("arn:") else role, access_key)
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = TokenBucket()
+            _rate_limiters[key] = limiter
+        return limiter
+
+
+
+def _get_session_key(config, region):
     role = config.get("assumeRole")
-    access_key = config.get("accessKey")
-    secret_key = config.get("secretKey")
+    if role:
+        return (region, role, None)
+    if config.get("accessKey") and config.get("secretKey"):
+        return (region, None, config["accessKey"])
+    return (region, None, None)
+
+
+def _make_session(config, region):
+    (region, role, access_key) = _get_session_key(config, region)
 
     if role:
-        sts = boto3.client("sts")
-        try:
-            response = sts.assume_role(RoleArn=role, RoleSessionName="dss-emr-access")
-        except:
-            logging.error("could not assume role %s" % role)
-            traceback.print_exc()
-            raise
-            
-        access_key = response["Credentials"]["AccessKeyId"]
-        secret_key = response["Credentials"]["SecretAccessKey"]
-        session_token = response["Credentials"]["SessionToken"]
-        
-        return boto3.client("emr", region_name=region, aws_access_key_id=access_key, aws_secret_access_key=secret_key, aws_session_token=session_token)
-    elif access_key and secret_key:
-        return boto3.client("emr", region_name=region, aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+        botocore_session = botocore.session.get_session()
+        botocore_session._credentials = botocore.credentials.RefreshableCredentials.create_from_metadata(
+            metadata=_assume_role(role),
+            refresh_using=lambda: _assume_role(role),
+            method="sts-assume-role")
+        return boto3.session.Session(botocore_session=botocore_session, region_name=region)
+    elif access_key:
+        return boto3.session.Session(aws_access_key_id=access_key, aws_secret_access_key=config["secretKey"], region_name=region)
     else:
-        return boto3.client('emr', region_name=region)
+        return boto3.session.Session(region_name=region)
+
+
+def _assume_role(role):
+    """Assumes a role and returns the credentials in the format expected by botocore's refreshable credentials"""
+
+    logging.info("assuming role %s" % role)
+    try:
+        response = _get_sts_client().assume_role(RoleArn=role, RoleSessionName=ASSUME_ROLE_SESSION_NAME)
+    except:
+        logging.error("could not assume role %s" % role)
+        traceback.print_exc()
+        raise
+    _session_stats["stsCalls"] += 1
+
+    credentials = response["Credentials"]
+    return {
+        "access_key": credentials["AccessKeyId"],
+        "secret_key": credentials["SecretAccessKey"],
+        "token": credentials["SessionToken"],
+        "expiry_time": credentials["Expiration"].isoformat()
+    }
+
+
+_sts_client = None
+
+def _get_sts_client():
+    # Called with _sessions_lock held on first use, and from botocore's refresh later on
+    global _sts_client
+    if _sts_client is None:
+        _sts_client = boto3.session.Session().client("sts")
+    return _sts_client
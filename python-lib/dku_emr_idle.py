@@ -0,0 +1,180 @@
+import botocore.exceptions
+import dku_cluster_services
+import dku_emr
+import dku_emr_scaling
+import logging
+import time
+
+# Idle manager: a cluster without YARN applications nor HiveServer2 sessions is idle. After
+# a while, its TASK nodes are removed, then it is terminated. The time since when the cluster
+# is idle, and what was done about it, are kept in a tag so that they survive between runs.
+IDLE_TAG = "dss-idle-manager"
+
+# What to do with a cluster idle for long enough, after removing its TASK nodes
+FINAL_ACTIONS = ["STOP", "AUTO_TERMINATION", "NONE"]
+
+
+def get_activity(master_address, hive_installed, rm_port=None, hs2_port=None):
+    """
+    Polls the YARN ResourceManager and HiveServer2 of a cluster
+
+    :param hive_installed: whether to poll HiveServer2
+    :param rm_port: HTTP port of the ResourceManager, the EMR default if None
+    :param hs2_port: HTTP port of the HiveServer2 web UI, the EMR default if None
+    :returns: dict with yarnAppsRunning, yarnAppsPending and hiveSessions (None if unknown)
+    """
+
+    def hive_sessions():
+        if not hive_installed:
+            return None
+        try:
+            sessions = dku_cluster_services.get_hiveserver2_sessions(master_address, hs2_port)
+        except Exception as e:
+            logging.warning("could not retrieve HiveServer2 sessions, only considering YARN: %s" % e)
+            return None
+        return sessions["openSessions"] if sessions else None
+
+    (metrics, sessions) = dku_emr.run_in_parallel(
+        lambda: dku_cluster_services.get_yarn_cluster_metrics(master_address, rm_port),
+        hive_sessions)
+    return {
+        "yarnAppsRunning": metrics.get("appsRunning", 0),
+        "yarnAppsPending": metrics.get("appsPending", 0),
+        "hiveSessions": sessions
+    }
+
+
+def is_idle(activity):
+    return not activity["yarnAppsRunning"] and not activity["yarnAppsPending"] and not activity["hiveSessions"]
+
+
+def compute_idle_action(idle_seconds, task_capacity, shrink_after, terminate_after=None):
+    """
+    Decides what to do with an idle cluster
+
+    :param task_capacity: current instances, or capacity units, of the TASK nodes
+    :param shrink_after: idle time in seconds after which to remove the TASK nodes
+    :param terminate_after: idle time in seconds after which to terminate the cluster, None to never terminate
+    :returns: tuple ("none", "shrink" or "terminate", human-readable reason)
+    """
+
+    reason = "idle for %d minutes" % (idle_seconds // 60)
+    if terminate_after is not None and idle_seconds >= terminate_after:
+        return ("terminate", reason)
+    if task_capacity and idle_seconds >= shrink_after:
+        return ("shrink", reason)
+    return ("none", reason)
+
+
+def get_idle_state(cluster):
+    """
+    Returns the idle state of a cluster, recorded in its tags
+
+    :param cluster: the cluster description from describe_cluster
+    :returns: tuple (idle since timestamp, last stage: "idle", "shrunk" or "auto-termination"), or None if not idle
+    """
+
+    for tag in cluster.get("Tags", []):
+        if tag["Key"] == IDLE_TAG:
+            (since, stage) = tag["Value"].split(":", 1)
+            return (float(since), stage)
+    return None
+
+
+def record_idle_state(client, cluster_id, since, stage):
+    client.add_tags(ResourceId=cluster_id, Tags=[{"Key": IDLE_TAG, "Value": "%d:%s" % (since, stage)}])
+
+
+def evaluate(client, cluster_id, cluster_config, master_address, shrink_after, terminate_after, final_action="STOP",
+             auto_termination_timeout=600, dry_run=False):
+    """
+    Polls the activity of a cluster and shrinks it, or sets its auto-termination policy, if
+    it is idle for long enough. Stopping the DSS cluster is left to the caller.
+
+    :param shrink_after: idle time in seconds after which to remove the TASK nodes
+    :param terminate_after: idle time in seconds after which to apply the final action
+    :param final_action: one of FINAL_ACTIONS
+    :param auto_termination_timeout: for AUTO_TERMINATION, idle time in seconds after which EMR terminates the cluster
+    :returns: the decision, as a dict. Its action is "stop" when the caller should stop the DSS cluster.
+    """
+
+    if final_action not in FINAL_ACTIONS:
+        raise Exception("Unknown final action %s" % final_action)
+
+    cluster = client.describe_cluster(ClusterId=cluster_id)["Cluster"]
+    hive_installed = dku_emr.has_application([app["Name"] for app in cluster.get("Applications", [])], "Hive")
+    activity = get_activity(master_address, hive_installed)
+    state = get_idle_state(cluster)
+    now = time.time()
+    decision = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "activity": activity, "idleMinutes": 0, "action": "none"}
+
+    if not is_idle(activity):
+        decision["reason"] = "active"
+        if state is not None and not dry_run:
+            if state[1] == "auto-termination":
+                _set_auto_termination(client, cluster_id, None)
+            client.remove_tags(ResourceId=cluster_id, TagKeys=[IDLE_TAG])
+        logging.info("idle manager decision: %s" % decision)
+        return decision
+
+    if state is None:
+        state = (now, "idle")
+        if not dry_run:
+            record_idle_state(client, cluster_id, now, "idle")
+    idle_seconds = now - state[0]
+    decision["idleMinutes"] = int(idle_seconds // 60)
+
+    fleet = dku_emr.is_instance_fleet_cluster(client, cluster_id, cluster_config)
+    task_capacity = _get_task_capacity(client, cluster_id, fleet)
+    (action, decision["reason"]) = compute_idle_action(idle_seconds, task_capacity, shrink_after,
+                                                       terminate_after if final_action != "NONE" else None)
+    if action == "terminate" and final_action == "AUTO_TERMINATION":
+        # The cluster stays up until EMR sees it idle: remove the TASK nodes first
+        if task_capacity and state[1] == "idle":
+            action = "shrink"
+        elif state[1] == "auto-termination":
+            action = "none"
+            decision["reason"] += ", auto-termination policy already set"
+
+    if action == "none":
+        pass
+    elif dry_run:
+        decision["action"] = "dry run, would %s" % action
+    elif action == "shrink":
+        if fleet:
+            dku_emr_scaling.resize_instance_fleets(client, cluster_id, cluster_config, None, (0, 0))
+        else:
+            dku_emr_scaling.resize_instance_groups(client, cluster_id, cluster_config, None, 0)
+        record_idle_state(client, cluster_id, state[0], "shrunk")
+        decision["action"] = "removed %d TASK instances or units" % task_capacity
+    elif final_action == "AUTO_TERMINATION":
+        if _set_auto_termination(client, cluster_id, auto_termination_timeout):
+            record_idle_state(client, cluster_id, state[0], "auto-termination")
+            decision["action"] = "set auto-termination after %d idle minutes" % (auto_termination_timeout // 60)
+        else:
+            decision["action"] = "none, auto-termination policy not supported by the cluster"
+    else:
+        decision["action"] = "stop"
+
+    logging.info("idle manager decision: %s" % decision)
+    return decision
+
+
+def _get_task_capacity(client, cluster_id, fleet):
+    if fleet:
+        return sum([f.get("TargetOnDemandCapacity", 0) + f.get("TargetSpotCapacity", 0)
+                    for f in dku_emr.list_instance_fleets(client, cluster_id) if f["InstanceFleetType"] == "TASK"])
+    return sum([g["RequestedInstanceCount"] for g in dku_emr.list_instance_groups(client, cluster_id) if g["InstanceGroupType"] == "TASK"])
+
+
+def _set_auto_termination(client, cluster_id, idle_timeout):
+    try:
+        if idle_timeout:
+            client.put_auto_termination_policy(ClusterId=cluster_id, AutoTerminationPolicy={"IdleTimeout": int(idle_timeout)})
+        else:
+            client.remove_auto_termination_policy(ClusterId=cluster_id)
+        return True
+    except botocore.exceptions.ClientError as e:
+        # EMR 5.30 and 6.1 or later
+        logging.warning("could not change the auto-termination policy of %s: %s" % (cluster_id, e))
+        return False
@@ -0,0 +1,105 @@
+import copy
+
+# S3 I/O profiles: EMR configuration classifications -> properties. The emrfs-site and
+# core-site properties also go to the DSS Hadoop and Spark settings, so that DSS-side
+# clients and jobs run with the same settings as the cluster.
+IO_PROFILES = {
+    # Large sequential reads and writes, e.g. bulk Parquet or CSV datasets
+    "S3_THROUGHPUT": {
+        "emrfs-site": {
+            "fs.s3.maxConnections": "2000",
+            "fs.s3n.multipart.uploads.enabled": "true",
+            "fs.s3n.multipart.uploads.split.size": "134217728"
+        },
+        "core-site": {
+            "fs.s3a.connection.maximum": "500",
+            "fs.s3a.threads.max": "64",
+            "fs.s3a.fast.upload": "true",
+            "fs.s3a.multipart.threshold": "134217728",
+            "fs.s3a.multipart.size": "134217728"
+        },
+        "spark-defaults": {
+            "spark.sql.parquet.fs.optimized.committer.optimization-enabled": "true",
+            "spark.hadoop.parquet.enable.summary-metadata": "false",
+            "spark.sql.parquet.mergeSchema": "false",
+            "spark.sql.files.maxPartitionBytes": "268435456"
+        }
+    },
+    # Selective reads of columnar data: seek-heavy, with predicate pushdown
+    "S3_COLUMNAR_READS": {
+        "emrfs-site": {
+            "fs.s3.maxConnections": "2000"
+        },
+        "core-site": {
+            "fs.s3a.connection.maximum": "500",
+            "fs.s3a.threads.max": "64",
+            "fs.s3a.experimental.input.fadvise": "random",
+            "fs.s3a.readahead.range": "1048576"
+        },
+        "spark-defaults": {
+            "spark.sql.parquet.fs.optimized.committer.optimization-enabled": "true",
+            "spark.sql.parquet.filterPushdown": "true",
+            "spark.sql.parquet.enableVectorizedReader": "true",
+            "spark.sql.orc.impl": "native",
+            "spark.sql.orc.filterPushdown": "true",
+            "spark.sql.orc.enableVectorizedReader": "true",
+            "spark.sql.hive.metastorePartitionPruning": "true",
+            "spark.sql.files.maxPartitionBytes": "134217728"
+        }
+    }
+}
+
+# Classifications holding Hadoop properties, that Spark takes with the spark.hadoop. prefix
+HADOOP_CLASSIFICATIONS = ["emrfs-site", "core-site"]
+
+
+def make_io_configurations(profile):
+    """
+    Builds the EMR configurations of an I/O profile, for run_job_flow
+
+    :param profile: name of the profile, None or "DEFAULT" for the EMR defaults
+    :returns: list of configurations
+    """
+
+    if not profile or profile == "DEFAULT":
+        return []
+    if profile not in IO_PROFILES:
+        raise Exception("Unknown I/O profile %s" % profile)
+    return [{"Classification": c, "Properties": dict(p)} for (c, p) in sorted(IO_PROFILES[profile].items())]
+
+
+def get_io_overrides(profile):
+    """
+    Returns the DSS settings overrides matching an I/O profile
+
+    :returns: dict with lists of "hadoop" and "spark" overrides
+    """
+
+    overrides = {"hadoop": [], "spark": []}
+    for configuration in make_io_configurations(profile):
+        for (key, value) in sorted(configuration["Properties"].items()):
+            if configuration["Classification"] in HADOOP_CLASSIFICATIONS:
+                overrides["hadoop"].append({"key": key, "value": value})
+                overrides["spark"].append({"key": "spark.hadoop.%s" % key, "value": value})
+            elif configuration["Classification"] == "spark-defaults":
+                overrides["spark"].append({"key": key, "value": value})
+    return overrides
+
+
+def merge_configurations(configurations, more):
+    """
+    Merges lists of EMR configurations, as EMR expects each classification only once.
+    Properties of the first list win.
+    """
+
+    merged = copy.deepcopy(configurations)
+    by_classification = dict([(c["Classification"], c) for c in merged])
+    for configuration in more:
+        existing = by_classification.get(configuration["Classification"])
+        if existing is None:
+            configuration = copy.deepcopy(configuration)
+            merged.append(configuration)
+            by_classification[configuration["Classification"]] = configuration
+        else:
+            existing["Properties"] = dict(configuration.get("Properties", {}), **existing.get("Properties", {}))
+    return merged
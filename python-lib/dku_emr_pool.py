@@ -0,0 +1,203 @@
+import botocore.exceptions
+import dku_emr
+import dku_emr_idle
+import dku_emr_scaling
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+# Warm pool of EMR clusters. A stopped DSS cluster leaves its EMR cluster idle in the pool
+# instead of terminating it, and a starting DSS cluster with the same fingerprint (same
+# configuration) claims it instead of creating a new one.
+#
+# Pool clusters are named after their fingerprint, so that candidates are found with one
+# ListClusters call. Their state is in tags: "idle:<released at>" or "claimed:<token>".
+#
+# EMR tags have no conditional writes, so a claim is made safe by timing: a claimant only
+# writes its token on an idle cluster, writes it quickly after checking, then waits longer
+# than that before checking that its token is still there. Of concurrent claimants, only
+# the last writer finds its token, the others move to the next candidate.
+#
+# Tags are eventually consistent: a claimant could read its own token back from a stale
+# replica while another token has won. The token is therefore read back twice, a settle
+# delay apart, and must be there both times. Two claimants sharing a cluster would need tag
+# propagation to lag by more than twice the settle delay, which is not expected but not
+# guaranteed by EMR either.
+
+POOL_TAG_FINGERPRINT = "dss-pool-fingerprint"
+POOL_TAG_STATE = "dss-pool-state"
+
+CLAIM_SETTLE_SECONDS = 10
+CLAIM_READ_BACKS = 2
+MAX_CLAIM_WRITE_SECONDS = 3
+
+# Tags about the activity of the previous user of a cluster, removed when it changes hands
+USAGE_TAGS = [dku_emr_idle.IDLE_TAG, dku_emr_scaling.AUTOSCALER_TAG]
+
+# Settings that do not change the EMR cluster itself
+FINGERPRINT_EXCLUDED_KEYS = [
+    "awsRegionId", "useRole", "assumeRole", "accessKey", "secretKey", "maxPoolConnections",
+    "tags", "databasesToCreate", "sizeExecutors", "metricsExportPath"
+]
+
+
+def compute_fingerprint(config):
+    """
+    Computes the fingerprint of the EMR cluster a DSS cluster config creates: release,
+    instances, metastore, security, applications, storage, etc.
+    """
+
+    relevant = dict([(k, v) for (k, v) in config.items() if k not in FINGERPRINT_EXCLUDED_KEYS and not k.startswith("pool")])
+    # No profile and the default profile make the same cluster
+    relevant["ioProfile"] = config.get("ioProfile") or "DEFAULT"
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def make_pool_cluster_name(fingerprint):
+    return "DSS pool cluster fingerprint=%s" % fingerprint
+
+
+def make_pool_tags(fingerprint, dss_cluster_id):
+    """Returns the tags of a new pool cluster, claimed by the DSS cluster creating it"""
+
+    return [
+        {"Key": POOL_TAG_FINGERPRINT, "Value": fingerprint},
+        {"Key": POOL_TAG_STATE, "Value": "claimed:%s" % _make_claim_token(dss_cluster_id)}
+    ]
+
+
+def claim_cluster(client, fingerprint, dss_cluster_id, tags):
+    """
+    Claims an idle cluster of the pool
+
+    :param tags: tags to set on the claimed cluster, e.g. its name for the DSS cluster
+    :returns: the id of the claimed cluster, or None if there is no idle cluster with this fingerprint
+    """
+
+    candidates = _list_pool_clusters(client, fingerprint)
+    logging.info("%d clusters in the pool with fingerprint %s" % (len(candidates), fingerprint))
+    for cluster_id in candidates:
+        token = _make_claim_token(dss_cluster_id)
+        if _try_claim(client, cluster_id, fingerprint, token):
+            logging.info("claimed pool cluster %s" % cluster_id)
+            client.remove_tags(ResourceId=cluster_id, TagKeys=USAGE_TAGS)
+            client.add_tags(ResourceId=cluster_id, Tags=tags)
+            _set_idle_timeout(client, cluster_id, None)
+            return cluster_id
+    return None
+
+
+def release_cluster(client, cluster_id, cluster_config, fingerprint, max_idle_clusters, idle_ttl_seconds):
+    """
+    Puts a cluster back into the pool, unless the pool is full, the cluster is busy, or it
+    was resized (e.g. by the idle manager or the autoscaler) and no longer matches its
+    fingerprint. Idle clusters terminate by themselves after idle_ttl_seconds (EMR 5.30 and
+    6.1 or later). The pool size limit is not strict under concurrent releases.
+
+    :param cluster_config: the DSS cluster config the cluster was created from
+    :returns: whether the cluster was released, else it is up to the caller to terminate it
+    """
+
+    cluster = client.describe_cluster(ClusterId=cluster_id)["Cluster"]
+    if _get_tags(cluster).get(POOL_TAG_FINGERPRINT) != fingerprint or cluster["Status"]["State"] != "WAITING":
+        logging.info("cluster %s is not an idle pool cluster with fingerprint %s" % (cluster_id, fingerprint))
+        return False
+    if not _has_configured_size(client, cluster_id, cluster_config):
+        logging.info("cluster %s was resized, it does not match fingerprint %s anymore" % (cluster_id, fingerprint))
+        return False
+
+    idle = [c for c in _list_pool_clusters(client, fingerprint) if c != cluster_id and _reap_if_expired(client, c, idle_ttl_seconds)]
+    if len(idle) >= max_idle_clusters:
+        logging.info("pool is full: %d idle clusters with fingerprint %s" % (len(idle), fingerprint))
+        return False
+
+    _set_idle_timeout(client, cluster_id, idle_ttl_seconds)
+    client.remove_tags(ResourceId=cluster_id, TagKeys=USAGE_TAGS)
+    client.add_tags(ResourceId=cluster_id, Tags=[
+        {"Key": POOL_TAG_STATE, "Value": "idle:%d" % time.time()},
+        {"Key": "Name", "Value": "%s (idle)" % make_pool_cluster_name(fingerprint)}
+    ])
+    logging.info("released cluster %s to the pool" % cluster_id)
+    return True
+
+
+def _has_configured_size(client, cluster_id, cluster_config):
+    """Whether the CORE and TASK nodes of a cluster are as in the config it was created from"""
+
+    if dku_emr.is_instance_fleet_cluster(client, cluster_id, cluster_config):
+        current = dict([(f["InstanceFleetType"], (f.get("TargetOnDemandCapacity", 0), f.get("TargetSpotCapacity", 0)))
+                        for f in dku_emr.list_instance_fleets(client, cluster_id)])
+        expected = dict([(node_type, (int(cluster_config.get("%sFleetOnDemandCapacity" % prefix) or 0), int(cluster_config.get("%sFleetSpotCapacity" % prefix) or 0)))
+                         for (node_type, prefix) in [("CORE", "core"), ("TASK", "task")]])
+        return all([current.get(node_type, (0, 0)) == expected[node_type] for node_type in expected])
+
+    current = {}
+    for group in dku_emr.list_instance_groups(client, cluster_id):
+        current[group["InstanceGroupType"]] = current.get(group["InstanceGroupType"], 0) + group["RequestedInstanceCount"]
+    expected = {"CORE": int(cluster_config.get("coreInstanceCount") or 0), "TASK": int(cluster_config.get("taskInstanceCount") or 0)}
+    return all([current.get(node_type, 0) == expected[node_type] for node_type in expected])
+
+
+def _list_pool_clusters(client, fingerprint):
+    name = make_pool_cluster_name(fingerprint)
+    cluster_ids = []
+    for page in client.get_paginator("list_clusters").paginate(ClusterStates=["WAITING"]):
+        cluster_ids.extend([c["Id"] for c in page["Clusters"] if c["Name"] == name])
+    return cluster_ids
+
+
+def _try_claim(client, cluster_id, fingerprint, token):
+    cluster = client.describe_cluster(ClusterId=cluster_id)["Cluster"]
+    tags = _get_tags(cluster)
+    if tags.get(POOL_TAG_FINGERPRINT) != fingerprint or not tags.get(POOL_TAG_STATE, "").startswith("idle:") \
+            or cluster["Status"]["State"] != "WAITING":
+        return False
+
+    checked = time.time()
+    client.add_tags(ResourceId=cluster_id, Tags=[{"Key": POOL_TAG_STATE, "Value": "claimed:%s" % token}])
+    if time.time() - checked > MAX_CLAIM_WRITE_SECONDS:
+        # Another claimant may have checked its claim already. Abandon: if no one owns the
+        # cluster in the end, it terminates after its idle timeout.
+        logging.warning("claim of %s took too long, abandoning it" % cluster_id)
+        return False
+
+    for i in range(CLAIM_READ_BACKS):
+        time.sleep(CLAIM_SETTLE_SECONDS)
+        if _get_tags(client.describe_cluster(ClusterId=cluster_id)["Cluster"]).get(POOL_TAG_STATE) != "claimed:%s" % token:
+            return False
+    return True
+
+
+def _reap_if_expired(client, cluster_id, idle_ttl_seconds):
+    """Terminates an idle pool cluster past its time to live. Returns whether the cluster is still idle in the pool."""
+
+    state = _get_tags(client.describe_cluster(ClusterId=cluster_id)["Cluster"]).get(POOL_TAG_STATE, "")
+    if not state.startswith("idle:"):
+        return False
+    if time.time() - float(state.split(":", 1)[1]) > idle_ttl_seconds:
+        logging.info("terminating pool cluster %s, idle for too long" % cluster_id)
+        client.terminate_job_flows(JobFlowIds=[cluster_id])
+        return False
+    return True
+
+
+def _set_idle_timeout(client, cluster_id, idle_timeout):
+    try:
+        if idle_timeout:
+            client.put_auto_termination_policy(ClusterId=cluster_id, AutoTerminationPolicy={"IdleTimeout": int(idle_timeout)})
+        else:
+            client.remove_auto_termination_policy(ClusterId=cluster_id)
+    except botocore.exceptions.ClientError as e:
+        # Not supported by older releases: idle clusters are then only terminated when expired
+        # clusters are reaped, on releases
+        logging.warning("could not change the auto-termination policy of %s: %s" % (cluster_id, e))
+
+
+def _get_tags(cluster):
+    return dict([(t["Key"], t["Value"]) for t in cluster.get("Tags", [])])
+
+
+def _make_claim_token(dss_cluster_id):
+    return "%s/%s" % (dss_cluster_id, uuid.uuid4().hex[:12])
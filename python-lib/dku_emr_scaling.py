@@ -0,0 +1,490 @@
+import dku_cluster_services
+import dku_emr
+import dku_emr_sizing
+import logging
+import math
+import time
+
+RESIZE_FAILED_STATES = ['SUSPENDED', 'TERMINATING', 'TERMINATED', 'ARRESTED', 'SHUTTING_DOWN', 'ENDED']
+
+
+# HDFS usage above which the CORE group is not shrunk further
+HDFS_MAX_USAGE = 0.8
+
+
+def resize_instance_groups(client, cluster_id, cluster_config, core_target, task_target, shrink_policy=None, check_core_shrink=None):
+    """
+    Changes the number of instances of the CORE and TASK instance groups, adding the groups
+    if they do not exist yet
+
+    :param cluster_config: the DSS cluster config, for the instance types of new groups
+    :param core_target: target instance count of the CORE group, None to leave it unchanged
+    :param shrink_policy: optional, EMR shrink policy of the groups being shrunk, from :func:`make_shrink_policy`
+    :param check_core_shrink: optional function (current count, target count) -> allowed target count,
+                              called before shrinking the CORE group
+    :returns: dict of instance group id -> target instance count, for the groups being resized
+    """
+
+    logging.info("retrieving current instances")
+    groups = dku_emr.list_instance_groups(client, cluster_id)
+
+    core_group = None
+    task_group = None
+    for group in groups:
+        if group["InstanceGroupType"] == "CORE":
+            if not core_group:
+                core_group = group
+            else:
+                raise Exception("Configuration not supported: multiple CORE groups: %s" % groups)
+        elif group["InstanceGroupType"] == "TASK":
+            if not task_group:
+                task_group = group
+            else:
+                raise Exception("Configuration not supported: multiple TASK groups: %s" % groups)
+
+    logging.info("Current instance groups: core=%s task=%s" % (core_group, task_group))
+
+    if core_group and core_target is not None and core_target < core_group["RequestedInstanceCount"] and check_core_shrink is not None:
+        core_target = check_core_shrink(core_group["RequestedInstanceCount"], core_target)
+
+    instanceGroupsToAdd = []
+    instanceGroupsToModify = []
+
+    if core_group and core_target is not None and core_group["RequestedInstanceCount"] != core_target:
+        instanceGroupsToModify.append({
+                "InstanceGroupId" : core_group["Id"],
+                "InstanceCount" : int(core_target)
+            })
+    elif not core_group and core_target:
+        if not cluster_config.get("coreInstanceType"):
+            raise Exception("Missing core instance type in cluster config")
+        instanceGroupsToAdd.append(dict({
+                'InstanceRole': 'CORE',
+                'InstanceType': cluster_config["coreInstanceType"],
+                'InstanceCount': int(core_target)
+            }, **dku_emr.make_storage_settings(cluster_config, 'CORE')))
+
+    if task_group and task_group["RequestedInstanceCount"] != task_target:
+        instanceGroupsToModify.append({
+                "InstanceGroupId" : task_group["Id"],
+                "InstanceCount" : int(task_target)
+            })
+    elif not task_group and task_target:
+        if not cluster_config.get("taskInstanceType"):
+            raise Exception("Missing task instance type in cluster config")
+        instanceGroupsToAdd.append(dict({
+                'InstanceRole': 'TASK',
+                'InstanceType': cluster_config["taskInstanceType"],
+                'InstanceCount': int(task_target)
+            }, **dku_emr.make_storage_settings(cluster_config, 'TASK')))
+
+    targets = dict([(g["InstanceGroupId"], g["InstanceCount"]) for g in instanceGroupsToModify])
+
+    if shrink_policy:
+        current = dict([(g["Id"], g["RequestedInstanceCount"]) for g in groups])
+        shrinking = [g for g in instanceGroupsToModify if g["InstanceCount"] < current[g["InstanceGroupId"]]]
+        instance_groups = _get_instance_groups_of_instances(client, cluster_id, shrink_policy) if shrinking else {}
+        for g in shrinking:
+            g["ShrinkPolicy"] = _filter_shrink_policy(shrink_policy, g["InstanceGroupId"], instance_groups)
+
+    if instanceGroupsToAdd:
+        logging.info("Adding new instance groups: %s" % instanceGroupsToAdd)
+        response = client.add_instance_groups(InstanceGroups=instanceGroupsToAdd, JobFlowId=cluster_id)
+        for (groupId, group) in zip(response["InstanceGroupIds"], instanceGroupsToAdd):
+            targets[groupId] = group["InstanceCount"]
+
+    if instanceGroupsToModify:
+        logging.info("Modifying current instance groups: %s" % instanceGroupsToModify)
+        client.modify_instance_groups(ClusterId=cluster_id, InstanceGroups=instanceGroupsToModify)
+
+    return targets
+
+
+def make_shrink_policy(decommission_timeout=None, instances_to_protect=None, instances_to_terminate=None, instance_termination_timeout=None):
+    """
+    Builds an EMR shrink policy, for graceful scale-down of instance groups
+
+    :param decommission_timeout: seconds given to the nodes to finish their YARN containers and
+                                 move their HDFS blocks away before they are terminated, None for the EMR default
+    :param instances_to_protect: EC2 instance ids that must not be terminated
+    :param instances_to_terminate: EC2 instance ids to terminate first
+    :param instance_termination_timeout: seconds given to the instances to terminate to be decommissioned
+    :returns: the shrink policy, or None if there is nothing to set
+    """
+
+    policy = {}
+    if decommission_timeout:
+        policy["DecommissionTimeout"] = int(decommission_timeout)
+    resize_policy = {}
+    if instances_to_protect:
+        resize_policy["InstancesToProtect"] = list(instances_to_protect)
+    if instances_to_terminate:
+        resize_policy["InstancesToTerminate"] = list(instances_to_terminate)
+    if resize_policy and instance_termination_timeout:
+        resize_policy["InstanceTerminationTimeout"] = int(instance_termination_timeout)
+    if resize_policy:
+        policy["InstanceResizePolicy"] = resize_policy
+    return policy or None
+
+
+def _get_instance_groups_of_instances(client, cluster_id, shrink_policy):
+    instance_ids = set(shrink_policy.get("InstanceResizePolicy", {}).get("InstancesToProtect", []) +
+                       shrink_policy.get("InstanceResizePolicy", {}).get("InstancesToTerminate", []))
+    if not instance_ids:
+        return {}
+    instances = dku_emr.list_instances(client, cluster_id, "CORE") + dku_emr.list_instances(client, cluster_id, "TASK")
+    found = dict([(i["instanceId"], i["instanceGroupId"]) for i in instances if i["instanceId"] in instance_ids])
+    if len(found) != len(instance_ids):
+        raise Exception("Instances not found in the CORE and TASK groups: %s" % ", ".join(sorted(instance_ids - set(found))))
+    return found
+
+
+def _filter_shrink_policy(shrink_policy, group_id, instance_groups):
+    # Each group only accepts its own instances in its resize policy
+    policy = dict(shrink_policy)
+    if "InstanceResizePolicy" in policy:
+        resize_policy = dict(policy["InstanceResizePolicy"])
+        for key in ("InstancesToProtect", "InstancesToTerminate"):
+            if key in resize_policy:
+                resize_policy[key] = [i for i in resize_policy[key] if instance_groups.get(i) == group_id]
+                if not resize_policy[key]:
+                    del resize_policy[key]
+        policy["InstanceResizePolicy"] = resize_policy
+    return policy
+
+
+def compute_core_shrink_target(hdfs_status, current_count, target_count, max_usage=HDFS_MAX_USAGE):
+    """
+    Computes how far the CORE group can shrink without losing HDFS data or filling HDFS up.
+    Keeps at least as many nodes as the replication factor, and enough nodes to hold the
+    used HDFS space under max_usage. Does not shrink while blocks are under-replicated.
+
+    :param hdfs_status: the HDFS status, from :func:`dku_cluster_services.get_hdfs_status`
+    :returns: tuple (allowed target count, human-readable reason)
+    """
+
+    if target_count >= current_count:
+        return (target_count, "not shrinking")
+    if hdfs_status["missingBlocks"] or hdfs_status["underReplicatedBlocks"]:
+        return (current_count, "%d under-replicated and %d missing HDFS blocks, not shrinking while HDFS re-replicates" % (
+            hdfs_status["underReplicatedBlocks"], hdfs_status["missingBlocks"]))
+
+    node_capacity = float(hdfs_status["capacityTotal"]) / max(1, hdfs_status["liveDataNodes"])
+    needed = int(math.ceil(hdfs_status["capacityUsed"] / (node_capacity * max_usage))) if node_capacity else current_count
+    allowed = min(current_count, max(target_count, hdfs_status["replication"], needed))
+    reason = "replication factor %d, %.1fGB used in HDFS needs %d nodes to stay under %d%% usage" % (
+        hdfs_status["replication"], hdfs_status["capacityUsed"] / 1e9, needed, max_usage * 100)
+    return (allowed, reason)
+
+
+def resize_instance_fleets(client, cluster_id, cluster_config, core_target, task_target, check_core_shrink=None):
+    """
+    Changes the target capacities of the CORE and TASK instance fleets, adding the TASK
+    fleet if it does not exist yet
+
+    :param core_target: tuple (on-demand units, spot units), None to leave the CORE fleet unchanged
+    :param task_target: tuple (on-demand units, spot units), None to leave the TASK fleet unchanged
+    :param check_core_shrink: optional function (current count, target count) -> allowed target count,
+                              in nodes, called before shrinking the CORE fleet
+    :returns: dict of instance fleet id -> target (on-demand units, spot units), for the fleets being resized
+    """
+
+    logging.info("retrieving current instance fleets")
+    fleets = dict([(f["InstanceFleetType"], f) for f in dku_emr.list_instance_fleets(client, cluster_id)])
+    logging.info("Current instance fleets: core=%s task=%s" % (fleets.get("CORE"), fleets.get("TASK")))
+
+    if fleets.get("CORE") and core_target is not None and check_core_shrink is not None:
+        core_target = _check_core_fleet_shrink(client, cluster_id, fleets["CORE"], core_target, check_core_shrink)
+
+    targets = {}
+    for (node_type, target) in [("CORE", core_target), ("TASK", task_target)]:
+        if target is None:
+            continue
+        (on_demand, spot) = target
+        fleet = fleets.get(node_type)
+        if fleet:
+            if (fleet.get("TargetOnDemandCapacity", 0), fleet.get("TargetSpotCapacity", 0)) != (on_demand, spot):
+                logging.info("Modifying %s fleet: on-demand=%d spot=%d" % (node_type, on_demand, spot))
+                client.modify_instance_fleet(ClusterId=cluster_id, InstanceFleet={
+                        "InstanceFleetId": fleet["Id"],
+                        "TargetOnDemandCapacity": int(on_demand),
+                        "TargetSpotCapacity": int(spot)
+                    })
+                targets[fleet["Id"]] = (on_demand, spot)
+        elif on_demand or spot:
+            if node_type == "CORE":
+                raise Exception("The CORE instance fleet can only be defined at cluster creation")
+            if not cluster_config.get("taskFleetInstanceTypes"):
+                raise Exception("Missing task fleet instance types in cluster config")
+            new_fleet = dku_emr.make_instance_fleet("TASK", cluster_config["taskFleetInstanceTypes"], on_demand, spot,
+                                                    spot_allocation_strategy=cluster_config.get("spotAllocationStrategy") or "capacity-optimized",
+                                                    spot_timeout_minutes=cluster_config.get("spotTimeoutMinutes") or 20,
+                                                    spot_timeout_action=cluster_config.get("spotTimeoutAction") or "SWITCH_TO_ON_DEMAND",
+                                                    storage_settings=dku_emr.make_storage_settings(cluster_config, "TASK"))
+            logging.info("Adding TASK fleet: %s" % new_fleet)
+            response = client.add_instance_fleet(ClusterId=cluster_id, InstanceFleet=new_fleet)
+            targets[response["InstanceFleetId"]] = (on_demand, spot)
+
+    return targets
+
+
+def _check_core_fleet_shrink(client, cluster_id, fleet, target, check_core_shrink):
+    """
+    Applies the CORE shrink check to a fleet, whose capacities are in units: converts them
+    to nodes with the average units per running node. Capacity kept is kept on-demand first.
+    """
+
+    current = (fleet.get("TargetOnDemandCapacity", 0), fleet.get("TargetSpotCapacity", 0))
+    if sum(target) >= sum(current):
+        return target
+    nodes = len(dku_emr.list_instances(client, cluster_id, "CORE", instance_states=["RUNNING"], fleet=True))
+    provisioned = fleet.get("ProvisionedOnDemandCapacity", 0) + fleet.get("ProvisionedSpotCapacity", 0)
+    if not nodes or not provisioned:
+        return target
+    units_per_node = float(provisioned) / nodes
+    target_nodes = int(math.ceil(sum(target) / units_per_node))
+    allowed_nodes = check_core_shrink(nodes, target_nodes)
+    if allowed_nodes <= target_nodes:
+        return target
+
+    missing = min(sum(current), int(math.ceil(allowed_nodes * units_per_node))) - sum(target)
+    on_demand = min(current[0], target[0] + max(0, missing))
+    spot = min(current[1], target[1] + max(0, missing - (on_demand - target[0])))
+    logging.info("CORE fleet capped to on-demand=%d spot=%d, %.1f units per node" % (on_demand, spot, units_per_node))
+    return (on_demand, spot)
+
+
+def scale_cluster(client, cluster_id, cluster_config, core_target, task_target, core_spot_target=0, task_spot_target=0,
+                  wait=False, timeout=1800, progress_callback=None, shrink_policy=None, hdfs_check="cap", master_addresses=None):
+    """
+    Resizes the CORE and TASK instance groups, or instance fleets, of a cluster
+
+    :param core_target: target instance count of the CORE group, or on-demand capacity units of the CORE fleet
+    :param task_target: target instance count of the TASK group, or on-demand capacity units of the TASK fleet
+    :param core_spot_target: instance fleets only, spot capacity units of the CORE fleet
+    :param task_spot_target: instance fleets only, spot capacity units of the TASK fleet
+    :param wait: whether to wait for the resize to complete
+    :param shrink_policy: instance groups only, optional shrink policy from :func:`make_shrink_policy`
+    :param hdfs_check: what to do when shrinking the CORE group or fleet would endanger HDFS: "cap"
+                       the shrink, "refuse" it, or "none" to not check
+    :param master_addresses: private addresses of the masters, the active one first, where the HDFS
+                             check looks for the active NameNode. Discovered if None.
+    :returns: dict with the resize targets, the worker nodes, the instances drained by the resize
+              (only when waiting), the outcome of the HDFS check, and the executor sizing the new size allows
+    """
+
+    fleet = dku_emr.is_instance_fleet_cluster(client, cluster_id, cluster_config)
+    before = _list_worker_instances(client, cluster_id, fleet) if wait else None
+    core_shrink = {}
+    check = None
+    if hdfs_check != "none":
+        check = lambda current, target: _check_core_shrink(client, cluster_id, master_addresses, current, target,
+                                                           hdfs_check == "refuse", core_shrink)
+    if fleet:
+        targets = resize_instance_fleets(client, cluster_id, cluster_config,
+                                         (core_target, core_spot_target), (task_target, task_spot_target), check_core_shrink=check)
+        if wait and targets:
+            wait_for_fleet_resize(client, cluster_id, targets, timeout=timeout, progress_callback=progress_callback)
+    else:
+        targets = resize_instance_groups(client, cluster_id, cluster_config, core_target, task_target,
+                                         shrink_policy=shrink_policy, check_core_shrink=check)
+        if wait and targets:
+            wait_for_resize(client, cluster_id, targets, timeout=timeout, progress_callback=progress_callback)
+
+    drained = None
+    if wait:
+        remaining = set([i["instanceId"] for i in _list_worker_instances(client, cluster_id, fleet)])
+        drained = [i for i in before if i["instanceId"] not in remaining]
+        logging.info("drained instances: %s" % ", ".join(["%s (%s)" % (i["instanceId"], i["instanceGroupType"]) for i in drained]))
+
+    # Executor shapes do not depend on the number of nodes and dynamic allocation is
+    # uncapped, so running jobs use new nodes. Report what the new size allows.
+    worker_nodes = dku_emr.list_worker_nodes(client, cluster_id, fleet=fleet)
+    return {"fleet": fleet, "targets": targets, "workerNodes": worker_nodes, "drainedInstances": drained,
+            "coreShrink": core_shrink or None, "sizing": dku_emr_sizing.compute_sizing(worker_nodes)}
+
+
+def _list_worker_instances(client, cluster_id, fleet):
+    (core, task) = dku_emr.run_in_parallel(lambda: dku_emr.list_instances(client, cluster_id, "CORE", fleet=fleet),
+                                           lambda: dku_emr.list_instances(client, cluster_id, "TASK", fleet=fleet))
+    return core + task
+
+
+def _check_core_shrink(client, cluster_id, master_addresses, current_count, target_count, refuse, outcome):
+    if master_addresses:
+        release_label = client.describe_cluster(ClusterId=cluster_id)["Cluster"].get("ReleaseLabel")
+    else:
+        discovery = dku_emr.discover_cluster(client, cluster_id)
+        release_label = discovery["cluster"].get("ReleaseLabel")
+        master_addresses = [discovery["masterAddress"]] + [inst["privateIpAddress"] for inst in discovery["masterInstances"]
+                                                           if inst["privateIpAddress"] != discovery["masterAddress"]]
+    hdfs_status = _get_active_hdfs_status(master_addresses, dku_emr.get_namenode_http_port(release_label))
+    logging.info("HDFS status: %s" % hdfs_status)
+    (allowed, reason) = compute_core_shrink_target(hdfs_status, current_count, target_count)
+    outcome.update({"requested": target_count, "allowed": allowed, "reason": reason})
+    if allowed != target_count:
+        if refuse:
+            raise Exception("Refusing to shrink the CORE nodes from %d to %d instances: %s" % (current_count, target_count, reason))
+        logging.warning("shrinking the CORE nodes to %d instances instead of %d: %s" % (allowed, target_count, reason))
+    return allowed
+
+
+def _get_active_hdfs_status(master_addresses, port):
+    """The NameNodes of multi-master clusters run on some of the masters, only the active one is up to date"""
+
+    for address in master_addresses:
+        try:
+            hdfs_status = dku_cluster_services.get_hdfs_status(address, port)
+        except Exception as e:
+            logging.warning("could not read the HDFS status from %s: %s" % (address, e))
+            continue
+        if hdfs_status["haState"] == "active":
+            return hdfs_status
+        logging.info("NameNode on %s is %s, trying the next master" % (address, hdfs_status["haState"]))
+    raise Exception("Could not read the HDFS status from an active NameNode on %s" % ", ".join(master_addresses))
+
+
+def compute_task_target(metrics, current_task_count, min_count, max_count, spare_nodes=1):
+    """
+    Computes a target size of the TASK group from YARN cluster metrics. Grows by as many
+    nodes as needed to fit the pending memory, and shrinks only when more than spare_nodes
+    nodes worth of memory are free, which keeps the size from oscillating.
+
+    :param metrics: the YARN ResourceManager cluster metrics
+    :returns: tuple (target count, human-readable reason)
+    """
+
+    if not metrics.get("activeNodes") or not metrics.get("totalMB"):
+        return (max(min(current_task_count, max_count), min_count), "no active YARN node")
+    node_mb = float(metrics["totalMB"]) / metrics["activeNodes"]
+
+    pending_mb = metrics.get("pendingMB")
+    if pending_mb is None:
+        # Older ResourceManagers do not report pending memory, estimate it from the average container
+        container_mb = float(metrics["allocatedMB"]) / metrics["containersAllocated"] if metrics.get("containersAllocated") else 1024
+        pending_mb = metrics.get("containersPending", 0) * container_mb
+
+    if pending_mb > 0:
+        target = current_task_count + int(math.ceil(pending_mb / node_mb))
+        reason = "%dMB pending, %dMB per node" % (pending_mb, node_mb)
+    else:
+        free_nodes = int(math.floor(metrics.get("availableMB", 0) / node_mb))
+        target = current_task_count - max(0, free_nodes - spare_nodes)
+        reason = "nothing pending, %d nodes worth of memory free, %d spare" % (free_nodes, spare_nodes)
+
+    return (max(min(target, max_count), min_count), reason)
+
+
+AUTOSCALER_TAG = "dss-autoscaler-last-action"
+
+
+def get_last_scaling_action(cluster):
+    """
+    Returns the last scaling action of the autoscaler on a cluster, recorded in its tags
+
+    :param cluster: the cluster description from describe_cluster
+    :returns: tuple (timestamp, "in" or "out"), or None
+    """
+
+    for tag in cluster.get("Tags", []):
+        if tag["Key"] == AUTOSCALER_TAG:
+            (timestamp, direction) = tag["Value"].split(":", 1)
+            return (float(timestamp), direction)
+    return None
+
+
+def record_scaling_action(client, cluster_id, direction):
+    client.add_tags(ResourceId=cluster_id, Tags=[{"Key": AUTOSCALER_TAG, "Value": "%d:%s" % (time.time(), direction)}])
+
+
+def wait_for_resize(client, cluster_id, targets, timeout=1800, progress_callback=None):
+    """
+    Waits until instance groups have reached their target number of running instances
+
+    :param targets: dict of instance group id -> target instance count
+    :param timeout: timeout in seconds
+    :param progress_callback: optional, called with the number of provisioned instances of all the
+                              CORE and TASK groups, resized or not, up to their target
+    :raises Exception: if a group goes into an error state, or on timeout
+    """
+
+    def poll():
+        all_groups = dku_emr.list_instance_groups(client, cluster_id)
+        groups = [g for g in all_groups if g["Id"] in targets]
+        workers = [g for g in all_groups if g["InstanceGroupType"] in ("CORE", "TASK")]
+        goal = lambda g: targets.get(g["Id"], g["RequestedInstanceCount"])
+        provisioned = sum([min(g["RunningInstanceCount"], goal(g)) for g in workers])
+        logging.info("resize progress: %d/%d instances provisioned (%s)" % (provisioned, sum([goal(g) for g in workers]),
+                ", ".join(["%s %s %d/%d" % (g["InstanceGroupType"], g["Status"]["State"], g["RunningInstanceCount"], goal(g)) for g in workers])))
+        if progress_callback is not None:
+            progress_callback(provisioned)
+
+        _check_states(groups, "InstanceGroupType")
+        # The transition RUNNING -> RESIZING is not synchronous, hence checking the counts too
+        if len(groups) == len(targets) and all([g["Status"]["State"] == "RUNNING" and g["RunningInstanceCount"] == targets[g["Id"]] for g in groups]):
+            return groups
+        return None
+
+    return dku_emr.wait_with_backoff(poll, timeout, "resize operation")
+
+
+def wait_for_fleet_resize(client, cluster_id, targets, timeout=1800, progress_callback=None):
+    """
+    Waits until instance fleets have reached their target capacities
+
+    :param targets: dict of instance fleet id -> target (on-demand units, spot units)
+    :param timeout: timeout in seconds
+    :param progress_callback: optional, called with the number of provisioned capacity units of the
+                              CORE and TASK fleets, resized or not, up to their target
+    :raises Exception: if a fleet goes into an error state, or on timeout
+    """
+
+    def poll():
+        all_fleets = dku_emr.list_instance_fleets(client, cluster_id)
+        fleets = [f for f in all_fleets if f["Id"] in targets]
+        workers = [f for f in all_fleets if f["InstanceFleetType"] in ("CORE", "TASK")]
+        goal = lambda f: targets.get(f["Id"], (f.get("TargetOnDemandCapacity", 0), f.get("TargetSpotCapacity", 0)))
+        provisioned = sum([min(f.get("ProvisionedOnDemandCapacity", 0), goal(f)[0]) +
+                           min(f.get("ProvisionedSpotCapacity", 0), goal(f)[1]) for f in workers])
+        logging.info("resize progress: %d/%d capacity units provisioned (%s)" % (provisioned, sum([sum(goal(f)) for f in workers]),
+                ", ".join(["%s %s on-demand %d/%d spot %d/%d" % (f["InstanceFleetType"], f["Status"]["State"],
+                                                                f.get("ProvisionedOnDemandCapacity", 0), goal(f)[0],
+                                                                f.get("ProvisionedSpotCapacity", 0), goal(f)[1]) for f in workers])))
+        if progress_callback is not None:
+            progress_callback(provisioned)
+
+        _check_states(fleets, "InstanceFleetType")
+        for f in fleets:
+            initial.setdefault(f["Id"], _get_provisioned_capacity(f))
+            if f["Status"]["State"] == "RESIZING":
+                resizing_seen.add(f["Id"])
+        if len(fleets) == len(targets) and all([f["Status"]["State"] == "RUNNING" and _is_fleet_resized(f, targets[f["Id"]])
+                                                for f in fleets]):
+            return fleets
+        return None
+
+    def _is_fleet_resized(fleet, target):
+        # With weighted instance types, EMR provisions until the target is met and may go over
+        # it, when growing as well as when shrinking. The transition RUNNING -> RESIZING is not
+        # synchronous: a shrinking fleet still RUNNING over its target may not have started.
+        for (provisioned, initial_capacity, target_capacity) in zip(_get_provisioned_capacity(fleet), initial[fleet["Id"]], target):
+            if initial_capacity > target_capacity:
+                if provisioned > target_capacity and fleet["Id"] not in resizing_seen:
+                    return False
+            elif provisioned < target_capacity:
+                return False
+        return True
+
+    initial = {}
+    resizing_seen = set()
+    return dku_emr.wait_with_backoff(poll, timeout, "resize operation")
+
+
+def _get_provisioned_capacity(fleet):
+    return (fleet.get("ProvisionedOnDemandCapacity", 0), fleet.get("ProvisionedSpotCapacity", 0))
+
+
+def _check_states(collections, type_key):
+    for c in collections:
+        if c["Status"]["State"] in RESIZE_FAILED_STATES:
+            raise Exception("%s %s is in state %s: %s" % (c[type_key], c["Id"], c["Status"]["State"], c["Status"].get("StateChangeReason", {}).get("Message")))
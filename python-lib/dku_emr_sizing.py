@@ -0,0 +1,114 @@
+import logging
+
+# Instance families: (memory GiB per vCPU, local instance storage GB per vCPU)
+INSTANCE_FAMILIES = {
+    "m4": (4, 0), "m5": (4, 0), "m5a": (4, 0), "m5d": (4, 37.5), "m6g": (4, 0), "m6gd": (4, 59.25), "m6i": (4, 0), "m7g": (4, 0),
+    "c4": (1.875, 0), "c5": (2, 0), "c5a": (2, 0), "c5d": (2, 25), "c6g": (2, 0), "c6gd": (2, 59.25), "c6i": (2, 0), "c7g": (2, 0),
+    "r4": (7.625, 0), "r5": (8, 0), "r5a": (8, 0), "r5d": (8, 37.5), "r6g": (8, 0), "r6gd": (8, 59.25), "r6i": (8, 0), "r7g": (8, 0),
+    "i3": (7.625, 237.5), "i3en": (8, 625), "z1d": (8, 37.5)
+}
+
+INSTANCE_SIZES = {
+    "large": 2, "xlarge": 4, "2xlarge": 8, "4xlarge": 16, "8xlarge": 32, "9xlarge": 36, "10xlarge": 40,
+    "12xlarge": 48, "16xlarge": 64, "18xlarge": 72, "24xlarge": 96
+}
+
+# Instance types that do not follow the per-vCPU ratios of their family
+INSTANCE_TYPE_EXCEPTIONS = {
+    "m4.large": (2, 8, 0),
+    "c4.8xlarge": (36, 60, 0)
+}
+
+# Executors with more cores than this get poor HDFS/S3 throughput
+MAX_EXECUTOR_CORES = 5
+
+
+def get_instance_type(instance_type):
+    """
+    Returns the specs of an EC2 instance type, from the embedded catalog
+
+    :returns: dict with vcpus, memoryMB, localStorageGB, or None if the instance type is unknown
+    """
+
+    if instance_type in INSTANCE_TYPE_EXCEPTIONS:
+        (vcpus, memory, storage) = INSTANCE_TYPE_EXCEPTIONS[instance_type]
+    else:
+        (family, _, size) = instance_type.partition(".")
+        if family not in INSTANCE_FAMILIES or size not in INSTANCE_SIZES:
+            return None
+        vcpus = INSTANCE_SIZES[size]
+        memory = INSTANCE_FAMILIES[family][0] * vcpus
+        storage = INSTANCE_FAMILIES[family][1] * vcpus
+    return {"vcpus": vcpus, "memoryMB": int(memory * 1024), "localStorageGB": int(storage)}
+
+
+def get_yarn_node_resources(instance_type):
+    """
+    Returns the memory and vcores EMR gives to the YARN NodeManager of an instance type,
+    following the EMR defaults of yarn.nodemanager.resource.memory-mb (the rest is kept for
+    the OS and the Hadoop daemons)
+
+    :returns: tuple (memory MB, vcores), or None if the instance type is unknown
+    """
+
+    specs = get_instance_type(instance_type)
+    if specs is None:
+        return None
+    ratio = 0.75 if specs["memoryMB"] < 64 * 1024 else 0.875
+    return (int(specs["memoryMB"] * ratio), specs["vcpus"])
+
+
+def compute_sizing(worker_nodes):
+    """
+    Derives Spark executor and Tez container sizes from the worker nodes of a cluster.
+    Executors are shaped after the smallest node type so that they fit on every node, and
+    dynamic allocation is left uncapped so that jobs follow the cluster when it is resized.
+    No override depends on the number of nodes, only totalCores, which is kept up to date in
+    the cluster data by the macros that resize the cluster.
+
+    :param worker_nodes: list of dicts with instanceType and count, as in the cluster discovery
+    :returns: dict with lists of "spark" and "hive" overrides, or None if no sizing is possible
+    """
+
+    nodes = [(get_yarn_node_resources(n["instanceType"]), n["count"]) for n in worker_nodes if n["count"]]
+    if not nodes:
+        return None
+    if [n for n in nodes if n[0] is None]:
+        logging.warning("unknown instance type in %s, not sizing executors" % worker_nodes)
+        return None
+
+    (node_mb, node_vcores) = min([n[0] for n in nodes])
+    # Largest number of cores that leaves no idle vcore on the node
+    executor_cores = [c for c in range(min(MAX_EXECUTOR_CORES, node_vcores), 0, -1) if node_vcores % c == 0][0]
+    executors_per_node = max(1, node_vcores // executor_cores)
+    executor_total_mb = node_mb // executors_per_node
+    # Spark reserves max(384MB, 10%) of overhead on top of the heap: both must fit in the budget
+    overhead_mb = max(384, executor_total_mb - int(executor_total_mb / 1.1))
+    executor_mb = executor_total_mb - overhead_mb
+
+    total_cores = sum([min(vcores // executor_cores, mb // executor_total_mb) * executor_cores * count
+                       for ((mb, vcores), count) in nodes])
+
+    tez_container_mb = max(1024, (node_mb // node_vcores) // 512 * 512)
+
+    logging.info("sizing for %s: %d executors of %d cores and %dMB per node, %d cores in total" % (
+        worker_nodes, executors_per_node, executor_cores, executor_mb, total_cores))
+
+    return {
+        "spark": [
+            {"key": "spark.executor.cores", "value": str(executor_cores)},
+            {"key": "spark.executor.memory", "value": "%dm" % executor_mb},
+            {"key": "spark.executor.memoryOverhead", "value": "%dm" % overhead_mb},
+            {"key": "spark.dynamicAllocation.enabled", "value": "true"},
+            {"key": "spark.shuffle.service.enabled", "value": "true"},
+            {"key": "spark.dynamicAllocation.minExecutors", "value": "0"},
+            {"key": "spark.dynamicAllocation.initialExecutors", "value": str(executors_per_node)}
+        ],
+        "hive": [
+            {"key": "hive.tez.container.size", "value": str(tez_container_mb)},
+            {"key": "hive.tez.java.opts", "value": "-Xmx%dm" % int(tez_container_mb * 0.8)},
+            {"key": "tez.am.resource.memory.mb", "value": str(tez_container_mb)},
+            {"key": "tez.runtime.io.sort.mb", "value": str(min(2047, int(tez_container_mb * 0.4)))}
+        ],
+        "totalCores": total_cores
+    }
@@ -0,0 +1,120 @@
+import dku_emr
+import dku_emr_tracing
+import logging
+import shlex
+
+STEP_DONE_STATES = ['COMPLETED', 'CANCELLED', 'FAILED', 'INTERRUPTED']
+
+# Maximum number of steps in one add_job_flow_steps call
+MAX_STEPS_PER_CALL = 256
+
+
+def parse_steps(text, action_on_failure="CONTINUE"):
+    """
+    Builds command-runner steps from text, one step per line, as "name: command" (name
+    without spaces) or just "command". Empty lines and lines starting with # are ignored.
+
+    :returns: list of steps for add_job_flow_steps
+    """
+
+    steps = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        (name, sep, command) = line.partition(": ")
+        if not sep or " " in name:
+            (name, command) = (None, line)
+        args = shlex.split(command)
+        steps.append({
+            "Name": name or " ".join(args)[:256],
+            "ActionOnFailure": action_on_failure,
+            "HadoopJarStep": {"Jar": "command-runner.jar", "Args": args}
+        })
+    return steps
+
+
+def set_step_concurrency_level(client, cluster_id, level):
+    """Changes the number of steps the cluster runs at the same time, between 1 and 256 (EMR 5.28 and later)"""
+
+    logging.info("setting step concurrency level of %s to %d" % (cluster_id, level))
+    return client.modify_cluster(ClusterId=cluster_id, StepConcurrencyLevel=int(level))["StepConcurrencyLevel"]
+
+
+def submit_steps(client, cluster_id, steps):
+    """
+    Submits steps to a cluster, in as few calls as possible
+
+    :returns: the list of step ids, in the order of the steps
+    """
+
+    step_ids = []
+    for start in range(0, len(steps), MAX_STEPS_PER_CALL):
+        batch = steps[start:start + MAX_STEPS_PER_CALL]
+        logging.info("submitting %d steps to %s" % (len(batch), cluster_id))
+        step_ids.extend(client.add_job_flow_steps(JobFlowId=cluster_id, Steps=batch)["StepIds"])
+    return step_ids
+
+
+def list_steps(client, cluster_id, step_ids):
+    """
+    Retrieves the status of steps. Steps are listed newest first, so listing stops as soon
+    as all the steps are found, usually on the first pages.
+
+    :returns: dict of step id -> compact step record
+    """
+
+    remaining = set(step_ids)
+    steps = {}
+    for page in client.get_paginator("list_steps").paginate(ClusterId=cluster_id):
+        for step in page["Steps"]:
+            if step["Id"] in remaining:
+                steps[step["Id"]] = _make_step_record(step)
+                remaining.discard(step["Id"])
+        if not remaining:
+            break
+    return steps
+
+
+def wait_for_steps(client, cluster_id, step_ids, timeout=3600, progress_callback=None):
+    """
+    Waits until steps are done, successfully or not
+
+    :param timeout: timeout in seconds
+    :param progress_callback: optional, called with the number of steps done
+    :returns: the list of step records, in the order of step_ids
+    """
+
+    def poll():
+        steps = list_steps(client, cluster_id, step_ids)
+        done = len([s for s in steps.values() if s["state"] in STEP_DONE_STATES])
+        running = len([s for s in steps.values() if s["state"] == "RUNNING"])
+        logging.info("steps progress: %d/%d done, %d running" % (done, len(step_ids), running))
+        if progress_callback is not None:
+            progress_callback(done)
+        if done == len(step_ids):
+            return [steps[i] for i in step_ids]
+        return None
+
+    return dku_emr.wait_with_backoff(poll, timeout, "steps")
+
+
+def _make_step_record(step):
+    status = step["Status"]
+    timeline = status.get("Timeline", {})
+    record = {
+        "id": step["Id"],
+        "name": step["Name"],
+        "state": status["State"],
+        "queuedSeconds": None,
+        "runningSeconds": None,
+        "failure": status.get("FailureDetails", {}).get("Message") or status.get("StateChangeReason", {}).get("Message")
+    }
+    created = timeline.get("CreationDateTime")
+    started = timeline.get("StartDateTime")
+    ended = timeline.get("EndDateTime")
+    if created is not None and started is not None:
+        record["queuedSeconds"] = round(dku_emr_tracing.to_timestamp(started) - dku_emr_tracing.to_timestamp(created), 1)
+    if started is not None and ended is not None:
+        record["runningSeconds"] = round(dku_emr_tracing.to_timestamp(ended) - dku_emr_tracing.to_timestamp(started), 1)
+    return record
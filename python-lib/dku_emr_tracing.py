@@ -0,0 +1,123 @@
+import calendar
+import contextlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+
+class PhaseTracer(object):
+    """
+    Records the duration of the phases of a cluster operation (start, attach, stop). Phases
+    may run in parallel threads.
+    """
+
+    def __init__(self, operation, labels=None):
+        """
+        :param operation: name of the operation, e.g. "start"
+        :param labels: dict of labels describing the cluster, e.g. release label and instance types
+        """
+        self.operation = operation
+        self.labels = dict(labels or {})
+        self.started = time.time()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Context manager timing a phase"""
+
+        start = time.time()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record(name, start, time.time(), failed=failed)
+
+    def record(self, name, start, end, failed=False):
+        with self.lock:
+            self.phases.append({"name": name, "start": start, "seconds": end - start, "failed": failed})
+        logging.info("%s phase %s took %.3fs%s" % (self.operation, name, end - start, " (failed)" if failed else ""))
+
+    def add_emr_timeline(self, cluster):
+        """
+        Records the provisioning time measured by EMR, from the timeline of a cluster description
+
+        :param cluster: the cluster description from describe_cluster
+        """
+
+        timeline = cluster.get("Status", {}).get("Timeline", {})
+        created = timeline.get("CreationDateTime")
+        ready = timeline.get("ReadyDateTime")
+        if created is not None and ready is not None:
+            self.record("emr_provisioning", to_timestamp(created), to_timestamp(ready))
+        if cluster.get("ReleaseLabel"):
+            self.labels.setdefault("release", cluster["ReleaseLabel"])
+
+    def summary(self):
+        """Returns a compact summary: total and per-phase durations in seconds"""
+
+        with self.lock:
+            phases = dict([(p["name"], round(p["seconds"], 3)) for p in self.phases])
+            failed = [p["name"] for p in self.phases if p["failed"]]
+        summary = {
+            "operation": self.operation,
+            "startedAt": int(self.started),
+            "totalSeconds": round(time.time() - self.started, 3),
+            "phases": phases,
+            "labels": self.labels
+        }
+        if failed:
+            summary["failedPhases"] = failed
+        return summary
+
+    def export(self, directory, dss_cluster_id):
+        """
+        Writes the summary as Prometheus metrics in <directory>/dss_emr_<cluster>_<operation>.prom,
+        for the node_exporter textfile collector, and appends it to <directory>/dss_emr_lifecycle.jsonl
+        """
+
+        summary = self.summary()
+        labels = dict(summary["labels"], operation=self.operation, dss_cluster=dss_cluster_id)
+        lines = [
+            "# HELP dss_emr_phase_duration_seconds Duration of a phase of a DSS EMR cluster operation",
+            "# TYPE dss_emr_phase_duration_seconds gauge"
+        ]
+        for (name, seconds) in sorted(summary["phases"].items()):
+            lines.append("dss_emr_phase_duration_seconds{%s} %s" % (_format_labels(dict(labels, phase=name)), seconds))
+        lines.extend([
+            "# HELP dss_emr_operation_duration_seconds Total duration of a DSS EMR cluster operation",
+            "# TYPE dss_emr_operation_duration_seconds gauge",
+            "dss_emr_operation_duration_seconds{%s} %s" % (_format_labels(labels), summary["totalSeconds"]),
+            "# HELP dss_emr_operation_timestamp_seconds Start time of the last DSS EMR cluster operation",
+            "# TYPE dss_emr_operation_timestamp_seconds gauge",
+            "dss_emr_operation_timestamp_seconds{%s} %s" % (_format_labels(labels), summary["startedAt"])
+        ])
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            name = re.sub(r"[^a-zA-Z0-9_-]", "_", "dss_emr_%s_%s" % (dss_cluster_id, self.operation))
+            path = os.path.join(directory, "%s.prom" % name)
+            # The textfile collector may read at any time: write then rename
+            with open("%s.%s" % (path, os.getpid()), "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.rename("%s.%s" % (path, os.getpid()), path)
+            with open(os.path.join(directory, "dss_emr_lifecycle.jsonl"), "a") as f:
+                f.write(json.dumps(dict(summary, dssCluster=dss_cluster_id)) + "\n")
+        except (IOError, OSError) as e:
+            logging.warning("could not export metrics to %s: %s" % (directory, e))
+
+
+def to_timestamp(value):
+    # botocore returns timezone-aware datetimes
+    if hasattr(value, "utctimetuple"):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    return float(value)
+
+
+def _format_labels(labels):
+    return ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for (k, v) in sorted(labels.items()) if v is not None])
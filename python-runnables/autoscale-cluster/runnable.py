@@ -0,0 +1,76 @@
+import dataiku
+import dku_cluster_services
+import dku_emr
+import dku_emr_scaling
+import logging
+import time
+from dataiku.runnables import Runnable
+
+# This actually belongs in the main entry point
+logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+logging.getLogger().setLevel(logging.INFO)
+
+class MyRunnable(Runnable):
+    def __init__(self, project_key, config, plugin_config):
+        self.project_key = project_key
+        self.config = config
+        self.plugin_config = plugin_config
+
+    def get_progress_target(self):
+        return None
+
+    def run(self, progress_callback):
+        dss_cluster = dataiku.api_client().get_cluster(self.config["dss_cluster_id"])
+        settings = dss_cluster.get_settings()
+        clusterConfig = settings.get_raw()["params"]["config"]
+        (client, emr_cluster_id) = dku_emr.get_client_and_wait(settings)
+
+        if dku_emr.is_instance_fleet_cluster(client, emr_cluster_id, clusterConfig):
+            raise Exception("Autoscaling is only supported for clusters with instance groups")
+
+        data = settings.get_plugin_data() or {}
+        master_address = data.get("masterAddress") or dku_emr.discover_cluster(client, emr_cluster_id)["masterAddress"]
+
+        deadline = time.time() + int(self.config.get("loop_minutes") or 0) * 60
+        interval = int(self.config.get("poll_interval_seconds") or 60)
+        decisions = []
+        while True:
+            decisions.append(self.evaluate(client, emr_cluster_id, clusterConfig, master_address))
+            if decisions[-1]["action"].startswith("scaled"):
+                dku_emr.record_worker_nodes(dss_cluster, dku_emr.list_worker_nodes(client, emr_cluster_id))
+            if time.time() + interval > deadline:
+                break
+            time.sleep(interval)
+
+        return {"decisions": decisions}
+
+    def evaluate(self, client, emr_cluster_id, clusterConfig, master_address):
+        (cluster, metrics, groups) = dku_emr.run_in_parallel(
+            lambda: client.describe_cluster(ClusterId=emr_cluster_id)["Cluster"],
+            lambda: dku_cluster_services.get_yarn_cluster_metrics(master_address),
+            lambda: dku_emr.list_instance_groups(client, emr_cluster_id))
+
+        task_groups = [g for g in groups if g["InstanceGroupType"] == "TASK"]
+        current = task_groups[0]["RequestedInstanceCount"] if task_groups else 0
+        (target, reason) = dku_emr_scaling.compute_task_target(metrics, current,
+                int(self.config.get("min_task_instances") or 0), int(self.config.get("max_task_instances") or 0),
+                spare_nodes=int(self.config.get("spare_nodes") or 0))
+
+        decision = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "currentTaskInstances": current, "targetTaskInstances": target, "reason": reason, "action": "none"}
+        if target != current:
+            direction = "out" if target > current else "in"
+            cooldown = int(self.config.get("scale_%s_cooldown_minutes" % direction) or 0) * 60
+            last = dku_emr_scaling.get_last_scaling_action(cluster)
+            if [g for g in groups if g["InstanceGroupType"] in ("CORE", "TASK") and g["Status"]["State"] != "RUNNING"]:
+                decision["action"] = "skipped, resize in progress"
+            elif last is not None and time.time() - last[0] < cooldown:
+                decision["action"] = "skipped, cooldown after scaling %s" % last[1]
+            elif self.config.get("dry_run", False):
+                decision["action"] = "dry run, would scale %s" % direction
+            else:
+                dku_emr_scaling.resize_instance_groups(client, emr_cluster_id, clusterConfig, None, target)
+                dku_emr_scaling.record_scaling_action(client, emr_cluster_id, direction)
+                decision["action"] = "scaled %s" % direction
+
+        logging.info("autoscaling decision: %s" % decision)
+        return decision
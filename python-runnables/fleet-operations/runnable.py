@@ -0,0 +1,127 @@
+import dataiku
+import dku_emr
+import dku_emr_scaling
+import dku_emr_sizing
+import fnmatch
+import logging
+import time
+from dataiku.runnables import Runnable, ResultTable
+from multiprocessing.pool import ThreadPool
+
+# This actually belongs in the main entry point
+logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+logging.getLogger().setLevel(logging.INFO)
+
+COLUMNS = [
+    ("dssCluster", "DSS cluster"),
+    ("emrClusterId", "EMR cluster"),
+    ("status", "Status"),
+    ("masterAddress", "Master"),
+    ("workers", "Workers"),
+    ("totalExecutorCores", "Executor cores"),
+    ("seconds", "Duration (s)"),
+    ("details", "Details")
+]
+
+class MyRunnable(Runnable):
+    def __init__(self, project_key, config, plugin_config):
+        self.project_key = project_key
+        self.config = config
+        self.plugin_config = plugin_config
+        self.dss_cluster_ids = None
+
+    def get_progress_target(self):
+        return (len(self.get_dss_cluster_ids()), 'NONE')
+
+    def get_dss_cluster_ids(self):
+        if self.dss_cluster_ids is None:
+            patterns = [p.strip() for p in self.config["dss_cluster_ids"].split(",") if p.strip()]
+            all_ids = [c["id"] for c in dataiku.api_client().list_clusters()]
+            self.dss_cluster_ids = [i for i in all_ids if [p for p in patterns if fnmatch.fnmatchcase(i, p)]]
+            logging.info("selected DSS clusters: %s" % self.dss_cluster_ids)
+        return self.dss_cluster_ids
+
+    def run(self, progress_callback):
+        dss_cluster_ids = self.get_dss_cluster_ids()
+        if not dss_cluster_ids:
+            raise Exception("No DSS cluster matches %s" % self.config["dss_cluster_ids"])
+
+        # The total time is that of the slowest cluster, as long as the pool is large enough
+        # and the rate limit is not reached
+        self.concurrency = max(1, min(int(self.config.get("max_concurrent_clusters") or 8), len(dss_cluster_ids)))
+        pool = ThreadPool(self.concurrency)
+        rows = [None] * len(dss_cluster_ids)
+        try:
+            for (done, (index, row)) in enumerate(pool.imap_unordered(self.process_cluster, enumerate(dss_cluster_ids))):
+                rows[index] = row
+                progress_callback(done + 1)
+        finally:
+            pool.close()
+
+        result = ResultTable()
+        result.set_name("%s of %d clusters" % (self.config.get("operation", "inventory").capitalize(), len(rows)))
+        for (key, label) in COLUMNS:
+            result.add_column(key, label, "STRING")
+        for row in rows:
+            result.add_record([None if row.get(key) is None else str(row[key]) for (key, _) in COLUMNS])
+        return result
+
+    def process_cluster(self, args):
+        (index, dss_cluster_id) = args
+        start = time.time()
+        row = {"dssCluster": dss_cluster_id}
+        try:
+            settings = dataiku.api_client().get_cluster(dss_cluster_id).get_settings()
+            data = settings.get_plugin_data()
+            if not data or not data.get("emrClusterId"):
+                row["status"] = "skipped, not a running EMR cluster"
+                return (index, row)
+            row["emrClusterId"] = data["emrClusterId"]
+
+            config = settings.get_raw()["params"]["config"]
+            region = config.get("awsRegionId") or dku_emr.get_current_region()
+            dku_emr.set_rate_limit(config, region, float(self.config.get("max_calls_per_second") or 0),
+                                   int(self.config.get("max_calls_burst") or 0))
+            # Clusters of the same account share a client, and the discovery makes 3 calls at once
+            (client, emr_cluster_id) = dku_emr.get_client_and_wait(settings, max_pool_connections=3 * self.concurrency)
+
+            if self.config.get("operation", "inventory") == "scale":
+                self.scale(client, emr_cluster_id, config, row)
+            else:
+                self.inventory(client, emr_cluster_id, row)
+        except Exception as e:
+            logging.exception("operation failed on DSS cluster %s" % dss_cluster_id)
+            row["status"] = "failed"
+            row["details"] = str(e)
+        row["seconds"] = "%.1f" % (time.time() - start)
+        return (index, row)
+
+    def inventory(self, client, emr_cluster_id, row):
+        discovery = dku_emr.discover_cluster(client, emr_cluster_id)
+        sizing = dku_emr_sizing.compute_sizing(discovery["workerNodes"])
+        row.update({
+            "status": discovery["cluster"]["Status"]["State"],
+            "masterAddress": discovery["masterAddress"],
+            "workers": _format_worker_nodes(discovery["workerNodes"]),
+            "totalExecutorCores": sizing["totalCores"] if sizing else None,
+            "details": discovery["cluster"].get("ReleaseLabel")
+        })
+
+    def scale(self, client, emr_cluster_id, config, row):
+        result = dku_emr_scaling.scale_cluster(client, emr_cluster_id, config,
+                int(self.config.get("core_group_target_instances", 0)), int(self.config.get("task_group_target_instances", 0)),
+                core_spot_target=int(self.config.get("core_fleet_target_spot_capacity") or 0),
+                task_spot_target=int(self.config.get("task_fleet_target_spot_capacity") or 0),
+                wait=self.config.get("wait_for_completion", False),
+                timeout=int(self.config.get("wait_timeout_minutes") or 30) * 60)
+        waited = self.config.get("wait_for_completion", False) and result["targets"]
+        row.update({
+            "status": "resized" if waited else ("resizing" if result["targets"] else "unchanged"),
+            "workers": _format_worker_nodes(result["workerNodes"]),
+            "totalExecutorCores": result["sizing"]["totalCores"] if result["sizing"] else None,
+            "details": ", ".join(["%s -> %s" % (k, v) for (k, v) in sorted(result["targets"].items())])
+        })
+
+
+def _format_worker_nodes(worker_nodes):
+    return ", ".join(["%s %d x %s" % (n["nodeType"], n["count"], n["instanceType"]) for n in worker_nodes])
@@ -18,32 +18,9 @@ class MyRunnable(Runnable):
         dss_cluster = dataiku.api_client().get_cluster(self.config["dss_cluster_id"])
         settings = dss_cluster.get_settings()
         (client, emr_cluster_id) = dku_emr.get_client_and_wait(settings)
+        fleet = dku_emr.is_instance_fleet_cluster(client, emr_cluster_id, settings.get_raw()["params"]["config"])
 
-        logging.info("retrieving instance groups")
-        instance_groups = client.list_instance_groups(ClusterId=emr_cluster_id)
-
-        logging.info("retrieving master instance")
-        master_instances = client.list_instances(ClusterId=emr_cluster_id,
-                InstanceGroupTypes=['MASTER'],
-                InstanceStates=['AWAITING_FULFILLMENT', 'PROVISIONING', 'BOOTSTRAPPING', 'RUNNING'])
-        master_instance_info = {"privateIpAddress" : master_instances['Instances'][0]["PrivateIpAddress"]}
-
-        logging.info("retrieving slave instances")
-        slave_instances = client.list_instances(ClusterId=emr_cluster_id,
-            InstanceGroupTypes=['CORE', 'TASK'],
-            InstanceStates=['AWAITING_FULFILLMENT', 'PROVISIONING', 'BOOTSTRAPPING', 'RUNNING'])
-        slave_instances_info = [
-                {"privateIpAddress":  inst["PrivateIpAddress"]} for inst in slave_instances["Instances"]]
-
-        return {
-            "masterInstance" : master_instance_info,
-            "slaveInstances":  slave_instances_info,
-            'instanceGroups':[
-                    {"instanceGroupId" : x["Id"],
-                     "runningInstanceCount": x["RunningInstanceCount"],
-                     "instanceType" : x["InstanceType"],
-                     "instanceGroupType" : x["InstanceGroupType"],
-                     "status": x["Status"]["State"]
-                    } for x in instance_groups["InstanceGroups"]]
-               }
-        
\ No newline at end of file
+        logging.info("retrieving cluster inventory")
+        inventory = dku_emr.get_cluster_inventory(client, emr_cluster_id, fleet=fleet)
+        logging.info("found %d master and %d slave instances" % (len(inventory["masterInstances"]), len(inventory["slaveInstances"])))
+        return inventory
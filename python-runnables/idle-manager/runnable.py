@@ -0,0 +1,66 @@
+import dataiku
+import dku_emr
+import dku_emr_idle
+import logging
+import time
+from dataiku.runnables import Runnable
+
+# This actually belongs in the main entry point
+logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+logging.getLogger().setLevel(logging.INFO)
+
+# Number of decisions kept in the cluster data
+MAX_RECORDED_DECISIONS = 20
+
+class MyRunnable(Runnable):
+    def __init__(self, project_key, config, plugin_config):
+        self.project_key = project_key
+        self.config = config
+        self.plugin_config = plugin_config
+
+    def get_progress_target(self):
+        return None
+
+    def run(self, progress_callback):
+        dss_cluster = dataiku.api_client().get_cluster(self.config["dss_cluster_id"])
+        settings = dss_cluster.get_settings()
+        clusterConfig = settings.get_raw()["params"]["config"]
+        (client, emr_cluster_id) = dku_emr.get_client_and_wait(settings)
+
+        data = settings.get_plugin_data() or {}
+        master_address = data.get("masterAddress") or dku_emr.discover_cluster(client, emr_cluster_id)["masterAddress"]
+
+        deadline = time.time() + int(self.config.get("loop_minutes") or 0) * 60
+        interval = int(self.config.get("poll_interval_seconds") or 300)
+        decisions = []
+        while True:
+            decision = dku_emr_idle.evaluate(client, emr_cluster_id, clusterConfig, master_address,
+                    int(self.config.get("shrink_after_idle_minutes") or 0) * 60,
+                    int(self.config.get("terminate_after_idle_minutes") or 0) * 60,
+                    final_action=self.config.get("final_action") or "STOP",
+                    auto_termination_timeout=int(self.config.get("auto_termination_idle_minutes") or 10) * 60,
+                    dry_run=self.config.get("dry_run", False))
+            decisions.append(decision)
+            self.record(dss_cluster, decision)
+            if decision["action"] == "stop":
+                logging.info("stopping DSS cluster %s" % self.config["dss_cluster_id"])
+                dss_cluster.stop()
+                break
+            if time.time() + interval > deadline:
+                break
+            time.sleep(interval)
+
+        return {"decisions": decisions}
+
+    def record(self, dss_cluster, decision):
+        """
+        Keeps the last decisions in the cluster data, for get-cluster-info and the DSS UI. The
+        settings are fetched again, not to overwrite changes made while the macro runs.
+        """
+        settings = dss_cluster.get_settings()
+        data = settings.get_plugin_data()
+        if not data:
+            return
+        recorded = data.get("idleManager", {}).get("decisions", [])
+        data["idleManager"] = {"decisions": (recorded + [decision])[-MAX_RECORDED_DECISIONS:]}
+        settings.save()
@@ -1,8 +1,8 @@
 import boto3
 import dataiku
 import dku_emr
+import dku_emr_scaling
 import logging
-import time
 from dataiku.runnables import Runnable
 
 # This actually belongs in the main entry point
@@ -14,9 +14,14 @@ class MyRunnable(Runnable):
         self.project_key = project_key
         self.config = config
         self.plugin_config = plugin_config
-        
+
     def get_progress_target(self):
-        return None
+        # The waiters report the provisioned instances, or capacity units, of all the CORE and
+        # TASK groups or fleets, not only of the resized ones
+        if not self.config.get("wait_for_completion", False):
+            return None
+        return (int(self.config.get("core_group_target_instances", 0)) + int(self.config.get("task_group_target_instances", 0))
+                + int(self.config.get("core_fleet_target_spot_capacity") or 0) + int(self.config.get("task_fleet_target_spot_capacity") or 0), 'NONE')
 
     def run(self, progress_callback):
         dss_cluster = dataiku.api_client().get_cluster(self.config["dss_cluster_id"])
@@ -24,85 +29,41 @@ class MyRunnable(Runnable):
         clusterConfig = settings.get_raw()["params"]["config"]
         (client, emr_cluster_id) = dku_emr.get_client_and_wait(settings)
 
-        logging.info("retrieving current instances")
-        response = client.list_instance_groups(ClusterId=emr_cluster_id)
-
-        core_group = None
-        task_group = None
-        for group in response["InstanceGroups"]:
-            if group["InstanceGroupType"] == "CORE":
-                if not core_group:
-                    core_group = group
-                else:
-                    raise Exception("Configuration not supported: multiple CORE groups: %s" % response["InstanceGroups"])
-            elif group["InstanceGroupType"] == "TASK":
-                if not task_group:
-                    task_group = group
-                else:
-                    raise Exception("Configuration not supported: multiple TASK groups: %s" % response["InstanceGroups"])
-
-        logging.info("Current instance groups: core=%s task=%s" % (core_group, task_group))
-
-        instanceGroupsToAdd = []
-        instanceGroupsToModify = []
-
-        if core_group and core_group["RequestedInstanceCount"] != self.config.get("core_group_target_instances", 0):
-            instanceGroupsToModify.append({
-                    "InstanceGroupId" : core_group["Id"],
-                    "InstanceCount" : int(self.config.get("core_group_target_instances", 0))
-                })
-        elif not core_group and self.config.get("core_group_target_instances"):
-            if not clusterConfig.get("coreInstanceType"):
-                raise Exception("Missing core instance type in cluster config")
-            instanceGroupsToAdd.append({
-                    'InstanceRole': 'CORE',
-                    'InstanceType': clusterConfig["coreInstanceType"],
-                    'InstanceCount': int(self.config["core_group_target_instances"])
-                })
+        # The HDFS check reaches the NameNode on the masters discovered when the cluster was started or attached
+        data = settings.get_plugin_data() or {}
+        master_addresses = None
+        if data.get("masterAddress"):
+            master_addresses = [data["masterAddress"]] + [a for a in data.get("masterAddresses", []) if a != data["masterAddress"]]
 
-        if task_group and task_group["RequestedInstanceCount"] != self.config.get("task_group_target_instances", 0):
-            instanceGroupsToModify.append({
-                    "InstanceGroupId" : task_group["Id"],
-                    "InstanceCount" : int(self.config.get("task_group_target_instances", 0))
-                })
-        elif not task_group and self.config.get("task_group_target_instances"):
-            if not clusterConfig.get("taskInstanceType"):
-                raise Exception("Missing task instance type in cluster config")
-            instanceGroupsToAdd.append({
-                    'InstanceRole': 'TASK',
-                    'InstanceType': clusterConfig["taskInstanceType"],
-                    'InstanceCount': int(self.config["task_group_target_instances"])
-                })
+        result = dku_emr_scaling.scale_cluster(client, emr_cluster_id, clusterConfig,
+                int(self.config.get("core_group_target_instances", 0)), int(self.config.get("task_group_target_instances", 0)),
+                core_spot_target=int(self.config.get("core_fleet_target_spot_capacity") or 0),
+                task_spot_target=int(self.config.get("task_fleet_target_spot_capacity") or 0),
+                wait=self.config.get("wait_for_completion", False),
+                timeout=int(self.config.get("wait_timeout_minutes") or 30) * 60,
+                progress_callback=progress_callback,
+                shrink_policy=dku_emr_scaling.make_shrink_policy(
+                    decommission_timeout=int(self.config.get("decommission_timeout_minutes") or 0) * 60,
+                    instances_to_protect=_split(self.config.get("instances_to_protect")),
+                    instances_to_terminate=_split(self.config.get("instances_to_terminate")),
+                    instance_termination_timeout=int(self.config.get("instance_termination_timeout_minutes") or 0) * 60),
+                hdfs_check=self.config.get("hdfs_check") or "cap",
+                master_addresses=master_addresses)
 
-        if instanceGroupsToAdd:
-            logging.info("Adding new instance groups: %s" % instanceGroupsToAdd)
-            client.add_instance_groups(InstanceGroups=instanceGroupsToAdd, JobFlowId=emr_cluster_id)
+        if self.config.get("wait_for_completion", False) and result["coreShrink"] and result["coreShrink"]["allowed"] != result["coreShrink"]["requested"]:
+            # The CORE group was not shrunk as far as requested: its instances counted past the target
+            progress_callback(self.get_progress_target()[0])
 
-        if instanceGroupsToModify:
-            logging.info("Modifying current instance groups: %s" % instanceGroupsToModify)
-            client.modify_instance_groups(ClusterId=emr_cluster_id, InstanceGroups=instanceGroupsToModify)
+        dku_emr.record_worker_nodes(dss_cluster, result["workerNodes"])
+        sizing = result["sizing"]
+        return {
+            "result": "Done",
+            "coreShrink": result["coreShrink"],
+            "drainedInstances": result["drainedInstances"],
+            "totalExecutorCores": sizing["totalCores"] if sizing else None,
+            "sparkOverrides": sizing["spark"] if sizing else None
+        }
 
-        if self.config.get("wait_for_completion", False):
-            # The transition RUNNING -> RESIZING is not synchronous
-            time.sleep(60)
-            i = 0
-            while True:
-                response = client.list_instance_groups(ClusterId=emr_cluster_id)
-                done = True
-                for group in response["InstanceGroups"]:
-                    instanceGroupType = group["InstanceGroupType"]
-                    state = group["Status"]["State"]
-                    if instanceGroupType == "CORE" or instanceGroupType == "TASK":
-                        # TODO check for error states?
-                        if state == "PROVISIONING" or state == "RESIZING":
-                            done = False
-                if done:
-                    break
-                elif i == 60:
-                    raise Exception("timeout waiting for resize operation to complete: %s" % response["InstanceGroups"])
-                else:
-                    logging.info("Waiting for resize operation to complete")
-                    i = i + 1
-                    time.sleep(30)
 
-        return "Done"
+def _split(instance_ids):
+    return [x.strip() for x in (instance_ids or "").split(",") if x.strip()]
@@ -0,0 +1,58 @@
+import dataiku
+import dku_emr
+import dku_emr_steps
+import logging
+from dataiku.runnables import Runnable, ResultTable
+
+# This actually belongs in the main entry point
+logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+logging.getLogger().setLevel(logging.INFO)
+
+COLUMNS = [
+    ("name", "Step"),
+    ("id", "Step id"),
+    ("state", "State"),
+    ("queuedSeconds", "Queued (s)"),
+    ("runningSeconds", "Running (s)"),
+    ("failure", "Failure")
+]
+
+class MyRunnable(Runnable):
+    def __init__(self, project_key, config, plugin_config):
+        self.project_key = project_key
+        self.config = config
+        self.plugin_config = plugin_config
+        self.steps = dku_emr_steps.parse_steps(self.config.get("steps") or "", self.config.get("action_on_failure") or "CONTINUE")
+
+    def get_progress_target(self):
+        if not self.config.get("wait_for_completion", False):
+            return None
+        return (len(self.steps), 'NONE')
+
+    def run(self, progress_callback):
+        if not self.steps:
+            raise Exception("No step to submit")
+
+        dss_cluster = dataiku.api_client().get_cluster(self.config["dss_cluster_id"])
+        settings = dss_cluster.get_settings()
+        (client, emr_cluster_id) = dku_emr.get_client_and_wait(settings)
+
+        if int(self.config.get("step_concurrency_level") or 0):
+            dku_emr_steps.set_step_concurrency_level(client, emr_cluster_id, int(self.config["step_concurrency_level"]))
+
+        step_ids = dku_emr_steps.submit_steps(client, emr_cluster_id, self.steps)
+        if self.config.get("wait_for_completion", False):
+            steps = dku_emr_steps.wait_for_steps(client, emr_cluster_id, step_ids,
+                                                 timeout=int(self.config.get("wait_timeout_minutes") or 60) * 60,
+                                                 progress_callback=progress_callback)
+        else:
+            found = dku_emr_steps.list_steps(client, emr_cluster_id, step_ids)
+            steps = [found.get(i) or {"id": i, "name": s["Name"], "state": "PENDING"} for (i, s) in zip(step_ids, self.steps)]
+
+        result = ResultTable()
+        result.set_name("%d steps on %s" % (len(steps), emr_cluster_id))
+        for (key, label) in COLUMNS:
+            result.add_column(key, label, "STRING")
+        for step in steps:
+            result.add_record([None if step.get(key) is None else str(step[key]) for (key, _) in COLUMNS])
+        return result